@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+""" benchmark: time panzer end to end on generated workloads
+
+usage: python3 benchmark/end_to_end.py [--workload NAME ...] [--runs N]
+                                       [--pandoc-delay SECONDS] [--cache]
+                                       [--save FILE] [--compare FILE]
+                                       [--threshold PERCENT]
+
+Each workload (a document, a hierarchy of style definitions, and filters
+and postprocessors that pass their input through) is generated in a
+temporary directory. panzer is then run on it `--runs` times, each in a
+new process, with `benchmark/fake_pandoc.py` as its pandoc executable, so
+that the times measure panzer's own overhead. The time of each stage is
+read from the trace that panzer writes with ---profile.
+
+The median, 90th percentile and maximum of the total time and of each
+stage are reported. `--save` writes them to a baseline file, and
+`--compare` reports each time whose median is more than `--threshold`
+percent slower than in a baseline, and exits with status 1 if any is.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FAKE_PANDOC = os.path.join(ROOT, 'benchmark', 'fake_pandoc.py')
+RUN_PANZER = ('import sys; sys.path.insert(0, %r); '
+              'from panzer import panzer; panzer.main()' % ROOT)
+
+# - workloads: paragraphs of document, depth of style hierarchy, metadata
+# - fields set by each style, and numbers of filters and postprocessors
+WORKLOADS = {
+    'small':        {'paragraphs': 10, 'depth': 1, 'fields': 5,
+                     'filters': 0, 'postprocessors': 0},
+    'large':        {'paragraphs': 5000, 'depth': 1, 'fields': 5,
+                     'filters': 1, 'postprocessors': 1},
+    'deep-styles':  {'paragraphs': 10, 'depth': 50, 'fields': 20,
+                     'filters': 0, 'postprocessors': 0},
+    'many-filters': {'paragraphs': 1000, 'depth': 2, 'fields': 5,
+                     'filters': 10, 'postprocessors': 10},
+}
+
+# - times differing by less than this are never reported as regressions
+MIN_DIFFERENCE = 0.002
+
+def generate(directory, workload):
+    """ write document and support directory of `workload` into `directory` """
+    styles = dict()
+    for level in range(workload['depth']):
+        style = {'all': {'metadata': {'field-%d-%d' % (level, i): 'value %d' % i
+                                      for i in range(workload['fields'])}}}
+        if level:
+            style['parent'] = 'Style%d' % (level - 1)
+        styles['Style%d' % level] = style
+    # - filters and postprocessors (`cat`) pass their input through
+    leaf = styles['Style%d' % (workload['depth'] - 1)]['all']
+    leaf['filter'] = [{'run': 'cat'}] * workload['filters']
+    leaf['postprocess'] = [{'run': 'cat'}] * workload['postprocessors']
+    support = os.path.join(directory, 'support')
+    os.makedirs(os.path.join(support, 'styles'))
+    # - json is yaml that the fake pandoc can read without PyYAML
+    with open(os.path.join(support, 'styles', 'styles.yaml'), 'w',
+              encoding='utf8') as styles_file:
+        json.dump(styles, styles_file, indent=1)
+    header = {'title': 'Benchmark',
+              'style': 'Style%d' % (workload['depth'] - 1)}
+    paragraphs = ['word%d ' % i * 40 for i in range(workload['paragraphs'])]
+    with open(os.path.join(directory, 'doc.md'), 'w', encoding='utf8') as doc:
+        doc.write('---\n%s\n...\n\n' % json.dumps(header))
+        doc.write('\n\n'.join(paragraphs) + '\n')
+    return support
+
+def run_once(directory, support, args):
+    """
+    run panzer on workload in `directory` and return dict of seconds taken
+    in total and by each stage
+    """
+    trace_path = os.path.join(directory, 'trace.json')
+    command = [sys.executable, '-c', RUN_PANZER, 'doc.md',
+               '--to', 'html', '--output', 'doc.html',
+               '---panzer-support', support,
+               '---pandoc', FAKE_PANDOC,
+               '---profile', trace_path,
+               '---quiet']
+    if not args.cache:
+        command.append('---no-cache')
+    env = dict(os.environ)
+    env['FAKE_PANDOC_DELAY'] = str(args.pandoc_delay)
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=directory, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times = {'total': time.perf_counter() - start}
+    if process.returncode != 0:
+        raise RuntimeError('panzer failed:\n%s' % process.stderr.decode('utf8'))
+    with open(trace_path, 'r', encoding='utf8') as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    for event in events:
+        if event.get('cat') == 'stage':
+            name = event['name']
+            times[name] = times.get(name, 0.0) + event['dur'] / 1e6
+    return times
+
+def percentile(values, percent):
+    """ return `percent` percentile of `values` (nearest rank) """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+def summarise(samples):
+    """ return median, 90th percentile and maximum of each list in `samples` """
+    return {name: {'median': statistics.median(values),
+                   'p90': percentile(values, 90),
+                   'max': max(values),
+                   'runs': len(values)}
+            for name, values in samples.items()}
+
+def benchmark(name, args):
+    """ return summary of times of `args.runs` runs of workload `name` """
+    directory = tempfile.mkdtemp(prefix='panzer-benchmark-')
+    try:
+        support = generate(directory, WORKLOADS[name])
+        # - first run is not timed: it warms the disk cache
+        run_once(directory, support, args)
+        samples = dict()
+        for _ in range(args.runs):
+            for stage, seconds in run_once(directory, support, args).items():
+                samples.setdefault(stage, list()).append(seconds)
+        return summarise(samples)
+    finally:
+        shutil.rmtree(directory)
+
+def report(results, baseline, threshold):
+    """
+    print `results`, compared with `baseline`, and return number of times
+    slower than in `baseline` by more than `threshold` percent
+    """
+    regressions = 0
+    print('%-14s %-24s %10s %10s %10s %10s' %
+          ('workload', 'stage', 'median', 'p90', 'max', 'baseline'))
+    for name, stages in results.items():
+        order = ['total'] + sorted(stage for stage in stages if stage != 'total')
+        for stage in order:
+            summary = stages[stage]
+            line = '%-14s %-24s %8.1fms %8.1fms %8.1fms' % \
+                (name, stage, summary['median'] * 1e3, summary['p90'] * 1e3,
+                 summary['max'] * 1e3)
+            base = baseline.get(name, dict()).get(stage)
+            if base:
+                change = summary['median'] / base['median'] - 1 if base['median'] else 0
+                line += ' %8.1fms %+6.1f%%' % (base['median'] * 1e3, change * 100)
+                if change * 100 > threshold \
+                and summary['median'] - base['median'] > MIN_DIFFERENCE:
+                    line += '  REGRESSION'
+                    regressions += 1
+            print(line)
+    return regressions
+
+def main():
+    """ run the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workload', action='append', choices=sorted(WORKLOADS),
+                        help='workload to run (default: all)')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--pandoc-delay', type=float, default=0.0,
+                        help='seconds that fake pandoc sleeps per conversion')
+    parser.add_argument('--cache', action='store_true',
+                        help="use panzer's cache (default: ---no-cache)")
+    parser.add_argument('--save', metavar='FILE', help='save results as baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with baseline')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent slowdown reported as regression')
+    args = parser.parse_args()
+    baseline = dict()
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    results = dict()
+    for name in args.workload or list(WORKLOADS):
+        results[name] = benchmark(name, args)
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w', encoding='utf8') as baseline_file:
+            json.dump({'python': sys.version.split()[0],
+                       'pandoc_delay': args.pandoc_delay,
+                       'cache': args.cache,
+                       'results': results}, baseline_file, indent=1, sort_keys=True)
+    if regressions:
+        print('%d regression(s) of more than %g%%' % (regressions, args.threshold))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
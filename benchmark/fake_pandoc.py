@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+""" deterministic stand-in for pandoc, used by the benchmarks
+
+usage: pass to panzer with `---pandoc benchmark/fake_pandoc.py`
+
+Answers panzer's probes (`--version`, `--list-input-formats`,
+`--list-output-formats`, `--help`), and converts:
+    - markdown to json: yaml metadata blocks become metadata, and each
+      paragraph (text between blank lines) a `Para` of `Str` and `Space`
+    - json to any format: the document is passed through unchanged, as
+      json, without being decoded
+Metadata blocks must be json (a subset of yaml), or else PyYAML must be
+installed. Options that do not change the output are accepted and ignored.
+
+The environment variable `FAKE_PANDOC_DELAY` sets a number of seconds to
+sleep before each conversion, to stand in for the time pandoc itself takes.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+VERSION = '2.19.2'
+API_VERSION = [1, 22, 2, 1]
+READERS = ['json', 'markdown']
+WRITERS = ['html', 'json', 'latex', 'markdown', 'plain']
+# - options that take an argument (others are flags)
+WITH_ARGUMENT = ['--read', '--from', '-r', '-f', '--write', '--to', '-w', '-t',
+                 '--output', '-o', '--lua-filter', '--filter', '--template',
+                 '--metadata', '-M', '--variable', '-V', '--data-dir',
+                 '--bibliography', '--csl', '--pdf-engine', '--resource-path']
+FLAGS = ['--standalone', '-s', '--number-sections', '--table-of-contents',
+         '--toc', '--self-contained', '--listings', '--verbose']
+
+METADATA_BLOCK = re.compile(r'(?ms)^---[ \t]*\n(.*?)\n(?:---|\.\.\.)[ \t]*$')
+
+def usage():
+    """ return text of `--help` """
+    return '\n'.join(['Usage: pandoc [OPTIONS] [FILES]']
+                     + ['  %s ARG' % option for option in WITH_ARGUMENT]
+                     + ['  %s' % option for option in FLAGS]) + '\n'
+
+def parse_arguments(args):
+    """ return input files, reader, writer and output file of `args` """
+    inputs = list()
+    settings = {'read': 'markdown', 'write': 'html', 'output': '-'}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg.startswith('--') and '=' in arg:
+            arg, value = arg.split('=', 1)
+        elif arg in WITH_ARGUMENT:
+            value = args[i]
+            i += 1
+        else:
+            if arg == '-' or not arg.startswith('-'):
+                inputs.append(arg)
+            continue
+        if arg in ('--read', '--from', '-r', '-f'):
+            settings['read'] = value.split('+')[0]
+        elif arg in ('--write', '--to', '-w', '-t'):
+            settings['write'] = value.split('+')[0]
+        elif arg in ('--output', '-o'):
+            settings['output'] = value
+    return inputs or ['-'], settings
+
+def read_bytes(name):
+    """ return contents of input file `name` ('-' is stdin) """
+    if name == '-':
+        return sys.stdin.buffer.read()
+    with open(name, 'rb') as input_file:
+        return input_file.read()
+
+def parse_yaml(text):
+    """ return mapping in metadata block `text` """
+    try:
+        return json.loads(text)
+    except ValueError:
+        import yaml                 # pylint: disable=C0415
+        return yaml.safe_load(text)
+
+def inlines(text):
+    """ return list of `Str` and `Space` inlines of `text` """
+    result = list()
+    for i, word in enumerate(text.split()):
+        if i:
+            result.append({'t': 'Space'})
+        result.append({'t': 'Str', 'c': word})
+    return result
+
+def meta_value(value):
+    """ return pandoc metadata value of yaml `value` """
+    if isinstance(value, bool):
+        return {'t': 'MetaBool', 'c': value}
+    if isinstance(value, dict):
+        return {'t': 'MetaMap', 'c': {key: meta_value(item)
+                                      for key, item in value.items()}}
+    if isinstance(value, list):
+        return {'t': 'MetaList', 'c': [meta_value(item) for item in value]}
+    if value is None:
+        return {'t': 'MetaInlines', 'c': []}
+    return {'t': 'MetaInlines', 'c': inlines(str(value))}
+
+def read_markdown(texts):
+    """ return ast of markdown `texts` """
+    metadata = dict()
+    blocks = list()
+    for text in texts:
+        for match in METADATA_BLOCK.finditer(text):
+            for key, value in (parse_yaml(match.group(1)) or dict()).items():
+                metadata[key] = meta_value(value)
+        for paragraph in METADATA_BLOCK.sub('', text).split('\n\n'):
+            if paragraph.strip():
+                blocks.append({'t': 'Para', 'c': inlines(paragraph)})
+    return {'pandoc-api-version': API_VERSION, 'meta': metadata, 'blocks': blocks}
+
+def main():
+    """ convert documents as pandoc would (for panzer's purposes) """
+    args = sys.argv[1:]
+    if '--version' in args:
+        sys.stdout.write('pandoc %s\nfake pandoc for panzer benchmarks\n' % VERSION)
+        return
+    if '--list-input-formats' in args:
+        sys.stdout.write('\n'.join(READERS) + '\n')
+        return
+    if '--list-output-formats' in args:
+        sys.stdout.write('\n'.join(WRITERS) + '\n')
+        return
+    if '--help' in args:
+        sys.stdout.write(usage())
+        return
+    inputs, settings = parse_arguments(args)
+    time.sleep(float(os.environ.get('FAKE_PANDOC_DELAY', 0)))
+    if settings['read'] == 'json':
+        out = read_bytes(inputs[0])
+    else:
+        ast = read_markdown([read_bytes(name).decode('utf8') for name in inputs])
+        out = json.dumps(ast, separators=(',', ':')).encode('utf8')
+    if settings['output'] == '-':
+        sys.stdout.buffer.write(out)
+    else:
+        with open(settings['output'], 'wb') as output_file:
+            output_file.write(out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+""" benchmark: encode and decode a large pandoc ast with each json backend
+
+usage: python3 benchmark/json_backends.py [--paragraphs N] [--repeat N]
+
+Compares each installed backend of `panzer.codec` with the str-based
+round trip that panzer used before (`json.dumps` then `.encode`, and
+`.decode` then `json.loads`). The `lazy` column times decoding only the
+metadata (`codec.loads_document`), as panzer does.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from panzer import codec        # pylint: disable=C0413
+
+def make_ast(paragraphs):
+    """ return pandoc ast with `paragraphs` paragraphs of mixed inlines """
+    blocks = list()
+    for i in range(paragraphs):
+        inlines = list()
+        for j in range(40):
+            inlines.append({'t': 'Str', 'c': 'word%d-%d' % (i, j)})
+            inlines.append({'t': 'Space'})
+        inlines.append({'t': 'Emph', 'c': [{'t': 'Str', 'c': 'émphasis'}]})
+        inlines.append({'t': 'Link',
+                        'c': [['', [], []],
+                              [{'t': 'Str', 'c': 'link'}],
+                              ['https://example.com/%d' % i, '']]})
+        blocks.append({'t': 'Para', 'c': inlines})
+        if i % 10 == 0:
+            blocks.append({'t': 'Header',
+                           'c': [2, ['sec-%d' % i, [], []],
+                                 [{'t': 'Str', 'c': 'Section %d' % i}]]})
+    return {'pandoc-api-version': [1, 22, 2, 1],
+            'meta': {'title': {'t': 'MetaInlines',
+                               'c': [{'t': 'Str', 'c': 'Benchmark'}]}},
+            'blocks': blocks}
+
+def best_of(repeat, function, *args):
+    """ return smallest time in seconds of `repeat` calls """
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    """ run the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--paragraphs', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    ast = make_ast(args.paragraphs)
+    data = json.dumps(ast, separators=(',', ':')).encode('utf8')
+    print('ast: %d paragraphs, %.1f MB of json' % (args.paragraphs, len(data) / 1e6))
+    print('%-18s %10s %10s %10s' % ('backend', 'encode', 'decode', 'lazy'))
+    encode = best_of(args.repeat, lambda: json.dumps(ast).encode('utf8'))
+    decode = best_of(args.repeat, lambda: json.loads(data.decode('utf8')))
+    print('%-18s %9.3fs %9.3fs %10s' % ('json (via str)', encode, decode, '-'))
+    for name in codec.available():
+        options = {'panzer': {'json_backend': name}}
+        codec.select(options)
+        encode = best_of(args.repeat, codec.dumps, ast)
+        decode = best_of(args.repeat, codec.loads, data)
+        lazy = best_of(args.repeat, codec.loads_document, data)
+        print('%-18s %9.3fs %9.3fs %9.3fs' % (name, encode, decode, lazy))
+
+if __name__ == '__main__':
+    main()
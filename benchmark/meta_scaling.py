@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+""" benchmark: how the metadata functions of `panzer.meta` scale
+
+usage: python3 benchmark/meta_scaling.py [--function NAME ...] [--repeat N]
+                                         [--scale N]
+
+Times each function on synthetic inputs of growing size: style definitions
+with wide, deep and diamond-shaped inheritance, metadata maps with many
+fields, run lists with many `run`, `kill` and `killall` items, and
+`commandline` maps with many values. For each size, the best of `--repeat`
+calls is reported, together with the growth exponent from the previous size
+(time ratio over size ratio, in log scale: 1 is linear, 2 quadratic).
+Exponents above `SUPER_LINEAR` are flagged. `--scale` multiplies the sizes.
+
+The memo of compiled style graphs (`meta.STYLE_GRAPHS`) is cleared before
+each call, so style hierarchies are timed cold. Entries ending in `/warm`
+time a hierarchy whose graph is already in the memo, as for later
+documents with the same style definitions.
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from panzer import info         # pylint: disable=C0413
+from panzer import meta         # pylint: disable=C0413
+
+# - growth exponents above this are flagged
+SUPER_LINEAR = 1.3
+
+# - times shorter than this are too noisy to give a growth exponent
+MIN_TIME = 1e-5
+
+# Generators of metadata values
+
+def inlines(text):
+    """ return MetaInlines of `text` """
+    words = list()
+    for i, word in enumerate(text.split(' ')):
+        if i:
+            words.append({'t': 'Space'})
+        words.append({'t': 'Str', 'c': word})
+    return {'t': 'MetaInlines', 'c': words}
+
+def code(text):
+    """ return MetaInlines of inline code `text` """
+    return {'t': 'MetaInlines', 'c': [{'t': 'Code', 'c': [['', [], []], text]}]}
+
+def meta_map(content):
+    """ return MetaMap of dict `content` """
+    return {'t': 'MetaMap', 'c': content}
+
+def meta_list(content):
+    """ return MetaList of list `content` """
+    return {'t': 'MetaList', 'c': content}
+
+def make_metadata(size):
+    """ return metadata with `size` fields """
+    return {'field%d' % i: inlines('value of field %d' % i) for i in range(size)}
+
+def make_runlist(size):
+    """
+    return MetaList of `size` run list items: mostly `run`, with every
+    tenth item a `kill` of an earlier item and a `killall` near the start
+    """
+    items = list()
+    for i in range(size):
+        if i == size // 20:
+            items.append(meta_map({'killall': {'t': 'MetaBool', 'c': True}}))
+        elif i % 10 == 9:
+            items.append(meta_map({'kill': inlines('filter%d.py' % (i - 5))}))
+        else:
+            items.append(meta_map({'run': inlines('filter%d.py' % i),
+                                   'args': code('--option %d' % i)}))
+    return meta_list(items)
+
+def make_style(fields, parents=()):
+    """ return definition of a style that sets `fields` metadata fields """
+    definition = {'all': meta_map({'metadata': meta_map(make_metadata(fields)),
+                                   'filter': make_runlist(2)})}
+    if parents:
+        definition['parent'] = meta_list([inlines(parent) for parent in parents])
+    return meta_map(definition)
+
+def make_styledef(shape, size):
+    """
+    return style definitions of `shape` with `size` styles, and the style
+    to expand:
+        wide    : one style with `size` parents
+        deep    : a chain of `size` styles, each the parent of the next
+        diamond : `size` layers, each of two styles whose parents are both
+                  styles of the layer below (so each style is reached by
+                  2^layers paths)
+    """
+    styledef = dict()
+    if shape == 'wide':
+        for i in range(size):
+            styledef['Parent%d' % i] = make_style(5)
+        styledef['Leaf'] = make_style(5, ['Parent%d' % i for i in range(size)])
+    elif shape == 'deep':
+        styledef['Level0'] = make_style(5)
+        for i in range(1, size):
+            styledef['Level%d' % i] = make_style(5, ['Level%d' % (i - 1)])
+        styledef['Leaf'] = make_style(5, ['Level%d' % (size - 1)])
+    elif shape == 'diamond':
+        styledef['Root'] = make_style(5)
+        below = ['Root']
+        for i in range(size):
+            layer = ['Left%d' % i, 'Right%d' % i]
+            for name in layer:
+                styledef[name] = make_style(5, below)
+            below = layer
+        styledef['Leaf'] = make_style(5, below)
+    return styledef, ['Leaf']
+
+def make_commandline(size):
+    """ return metadata with `commandline` map giving `size` css files """
+    return {'commandline': meta_map({
+        'standalone': {'t': 'MetaBool', 'c': True},
+        'toc-depth': code('3'),
+        'css': meta_list([code('style%d.css' % i) for i in range(size)])})}
+
+def make_cli_options(size):
+    """ return options dictionary with `size` repeated values """
+    return {'standalone': True,
+            'toc-depth': '3',
+            'variable': [['key%d=value%d' % (i, i)] for i in range(size)],
+            'metadata': [['field%d=%d' % (i, i)] for i in range(size)]}
+
+# Benchmarks: name, sizes, and function returning a call to time on inputs
+# of given size (inputs are made before the call is timed)
+
+def bench_update_metadata(size):
+    """ merge style definition with `size` metadata fields into metadata """
+    old = make_metadata(size)
+    new = meta.get_content(make_style(size)['c'], 'all', 'MetaMap')
+    return lambda: meta.update_metadata(old, new)
+
+def bench_update_additive_lists(size):
+    """ extend run lists of `size` items with another `size` items """
+    old = {'filter': make_runlist(size), 'postprocess': make_runlist(size)}
+    new = {'filter': make_runlist(size), 'postprocess': make_runlist(size)}
+    return lambda: meta.update_additive_lists(old, new)
+
+def bench_apply_kill_rules(size):
+    """ apply kill rules to run list of `size` items """
+    items = meta.get_content({'filter': make_runlist(size)}, 'filter', 'MetaList')
+    return lambda: meta.apply_kill_rules(items)
+
+def bench_expand_style_hierarchy(shape, warm=False):
+    """
+    expand style of hierarchy of `shape`
+    `warm`: expand it once before the timed call, to fill the memo
+    """
+    def setup(size):
+        """ expand hierarchy with `size` styles (or layers) """
+        styledef, stylelist = make_styledef(shape, size)
+        if warm:
+            meta.expand_style_hierarchy(stylelist, styledef)
+        return lambda: meta.expand_style_hierarchy(stylelist, styledef)
+    return setup
+
+def bench_parse_commandline(size):
+    """ parse `commandline` map with `size` css files """
+    metadata = make_commandline(size)
+    return lambda: meta.parse_commandline(metadata)
+
+def bench_build_cli_options(size):
+    """ build command line from options with `size` repeated values """
+    options = make_cli_options(size)
+    return lambda: meta.build_cli_options(options)
+
+BENCHMARKS = [
+    ('update_metadata',              [100, 1000, 10000, 100000],
+     bench_update_metadata),
+    ('update_additive_lists',        [100, 1000, 10000, 100000],
+     bench_update_additive_lists),
+    ('apply_kill_rules',             [100, 1000, 10000],
+     bench_apply_kill_rules),
+    ('expand_style_hierarchy/wide',  [100, 1000, 10000],
+     bench_expand_style_hierarchy('wide')),
+    ('expand_style_hierarchy/deep',  [10, 100, 500],
+     bench_expand_style_hierarchy('deep')),
+    ('expand_style_hierarchy/diamond', [4, 8, 12],
+     bench_expand_style_hierarchy('diamond')),
+    ('expand_style_hierarchy/wide/warm', [100, 1000, 10000],
+     bench_expand_style_hierarchy('wide', warm=True)),
+    ('expand_style_hierarchy/deep/warm', [10, 100, 500],
+     bench_expand_style_hierarchy('deep', warm=True)),
+    ('expand_style_hierarchy/diamond/warm', [4, 8, 12],
+     bench_expand_style_hierarchy('diamond', warm=True)),
+    ('parse_commandline',            [100, 1000, 10000, 100000],
+     bench_parse_commandline),
+    ('build_cli_options',            [100, 1000, 10000, 100000],
+     bench_build_cli_options),
+]
+
+def best_of(repeat, setup, size):
+    """ return smallest time in seconds of `repeat` calls made by `setup(size)` """
+    times = list()
+    for _ in range(repeat):
+        # - fresh inputs for each call, as some functions change them, and
+        # - no style graphs memoized by earlier calls
+        meta.STYLE_GRAPHS.clear()
+        call = setup(size)
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    """ run the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--function', action='append',
+                        choices=[name for name, _, _ in BENCHMARKS],
+                        help='function to time (default: all)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply sizes (except diamond layers) by this')
+    args = parser.parse_args()
+    # - functions log errors in their input: keep them out of the output
+    info.start_capture()
+    flagged = list()
+    print('%-36s %8s %12s %9s' % ('function', 'size', 'time', 'exponent'))
+    for name, sizes, setup in BENCHMARKS:
+        if args.function and name not in args.function:
+            continue
+        if '/diamond' not in name:
+            sizes = [max(1, int(size * args.scale)) for size in sizes]
+        previous = None
+        for size in sizes:
+            seconds = best_of(args.repeat, setup, size)
+            line = '%-36s %8d %10.3fms' % (name, size, seconds * 1e3)
+            if previous and min(seconds, previous[1]) > MIN_TIME:
+                exponent = math.log(seconds / previous[1]) \
+                    / math.log(size / previous[0])
+                line += ' %9.2f' % exponent
+                if exponent > SUPER_LINEAR:
+                    line += '  SUPER-LINEAR'
+                    flagged.append(name)
+            print(line)
+            previous = (size, seconds)
+    info.stop_capture()
+    if flagged:
+        print('super-linear: %s' % ', '.join(sorted(set(flagged))))
+
+if __name__ == '__main__':
+    main()
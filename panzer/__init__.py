@@ -4,3 +4,5 @@ import sys
 if sys.version_info[0] != 3:
     print("panzer cannot run --- it requires Python 3")
     sys.exit(1)
+
+from .panzer import render
@@ -0,0 +1,255 @@
+""" persistent on-disk cache for panzer
+
+Entries are gzip-compressed files, one per key, in a subdirectory of the
+cache directory for each kind of entry. An entry's modification time is
+refreshed whenever it is read. Each process keeps an estimate of the
+cache's size, and when a write takes it over the size limit the least
+recently used entries are removed until the cache is well within it.
+
+`Memo` is the in-memory counterpart, used for results kept by a process
+(e.g. a daemon worker) between documents: it holds a fixed number of the
+most recently used entries.
+"""
+import collections
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from . import const
+from . import info
+
+# - estimated size in bytes of each cache directory, and writes since it
+# - was measured, kept by this process (see `note_write`)
+SIZES = dict()
+SIZES_LOCK = threading.Lock()
+
+class Memo(object):
+    """ in-memory map that keeps only its `size` most recently used entries """
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ return value stored under `key`, or `default` if none """
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        """ store `value` under `key`, dropping least recently used entries """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """ remove all entries """
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+def cache_dir(options):
+    """ return directory in which cache files are stored """
+    if options['panzer']['cache_dir']:
+        return options['panzer']['cache_dir']
+    return os.path.join(options['panzer']['panzer_support'], const.CACHE_SUBDIR)
+
+def file_fingerprint(path):
+    """
+    return fingerprint of file at `path` based on its stat data
+    (None if the file cannot be found)
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+def max_size(options):
+    """ return size limit of cache in bytes """
+    megabytes = options['panzer']['cache_size'] or const.CACHE_MAX_SIZE
+    return megabytes * 1024 * 1024
+
+def make_key(*parts):
+    """ return hex digest that identifies the json-able `parts` """
+    data = json.dumps(parts, sort_keys=True)
+    return hashlib.sha256(data.encode(const.ENCODING)).hexdigest()
+
+def file_digest(path):
+    """ return sha256 hex digest of contents of file at `path` """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def entry_path(options, kind, key):
+    """ return path of cache entry of `kind` with `key` """
+    return os.path.join(cache_dir(options), kind, key + '.json.gz')
+
+def read(options, kind, key):
+    """
+    return data stored in cache entry of `kind` with `key`
+    returns None if cache is disabled, being rebuilt, or entry not found
+    """
+    content = read_bytes(options, kind, key)
+    if content is None:
+        return None
+    try:
+        return json.loads(content.decode(const.ENCODING))
+    except ValueError as err:
+        info.log('DEBUG', 'panzer', 'ignoring corrupt cache entry "%s": %s'
+                 % (entry_path(options, kind, key), err))
+        return None
+
+def write(options, kind, key, data):
+    """ store json-able `data` in cache entry of `kind` with `key` """
+    write_bytes(options, kind, key, json.dumps(data).encode(const.ENCODING))
+
+def read_bytes(options, kind, key):
+    """
+    return bytes stored in cache entry of `kind` with `key`
+    returns None if cache is disabled, being rebuilt, or entry not found
+    """
+    if options['panzer']['no_cache'] or options['panzer']['rebuild_cache']:
+        return None
+    path = entry_path(options, kind, key)
+    try:
+        with gzip.open(path, 'rb') as cache_file:
+            content = cache_file.read()
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError) as err:
+        # - gzip's checksum catches truncated or damaged entries
+        info.log('DEBUG', 'panzer', 'ignoring corrupt cache entry "%s": %s'
+                 % (path, err))
+        return None
+    info.log('DEBUG', 'panzer', 'cache hit "%s"' % path)
+    # - mark entry as recently used, so that `prune` keeps it
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return content
+
+def write_bytes(options, kind, key, content):
+    """ store bytes `content` in cache entry of `kind` with `key` """
+    if options['panzer']['no_cache']:
+        return
+    path = entry_path(options, kind, key)
+    temp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # - write to temp file then rename, so that concurrent panzer
+        # - processes never see a partially written entry
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                             prefix='.tmp-')
+        with os.fdopen(handle, 'wb') as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode='wb',
+                               compresslevel=1, mtime=0) as cache_file:
+                cache_file.write(content)
+        added = os.path.getsize(temp_path)
+        if os.path.exists(path):
+            added -= os.path.getsize(path)
+        os.replace(temp_path, path)
+    except OSError as err:
+        info.log('DEBUG', 'panzer', 'failed to write cache entry "%s": %s'
+                 % (path, err))
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    info.log('DEBUG', 'panzer', 'cache entry written "%s"' % path)
+    note_write(options, added)
+
+def note_write(options, added):
+    """
+    add `added` bytes to estimated size of cache, and prune the cache if
+    the estimate is over its size limit; the cache is measured on the
+    first write of this process, when pruned, and every
+    `const.CACHE_MEASURE_INTERVAL` writes
+    """
+    directory = cache_dir(options)
+    with SIZES_LOCK:
+        size, writes = SIZES.get(directory, (None, 0))
+        writes += 1
+        if size is not None and writes < const.CACHE_MEASURE_INTERVAL:
+            size += added
+            if size <= max_size(options):
+                SIZES[directory] = (size, writes)
+                return
+        SIZES[directory] = (prune(options), 0)
+
+def entries(options):
+    """ return list of (mtime, size, path) of each entry in cache """
+    found = list()
+    directory = cache_dir(options)
+    try:
+        kinds = os.listdir(directory)
+    except OSError:
+        return found
+    for kind in kinds:
+        kind_dir = os.path.join(directory, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for name in os.listdir(kind_dir):
+            # - skip temp files being written, and manifests
+            if not name.endswith('.json.gz') or name.startswith('.tmp-'):
+                continue
+            path = os.path.join(kind_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((stat.st_mtime, stat.st_size, path))
+    return found
+
+def prune(options):
+    """
+    if cache is over its size limit (`---cache-size`), remove least
+    recently used entries until it is within `const.CACHE_PRUNE_TO` of the
+    limit; return size of cache in bytes
+    """
+    found = entries(options)
+    total = sum(size for _, size, _ in found)
+    limit = max_size(options)
+    if total <= limit:
+        return total
+    target = limit * const.CACHE_PRUNE_TO
+    removed = 0
+    for _, size, path in sorted(found):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    info.log('DEBUG', 'panzer', 'cache over %dMB---removed %d oldest entries'
+             % (limit // (1024 * 1024), removed))
+    return total
+
+def clear(options):
+    """ remove every entry from cache, and return exit status """
+    removed = 0
+    for _, _, path in entries(options):
+        try:
+            os.remove(path)
+        except OSError as err:
+            info.log('ERROR', 'panzer', 'cannot remove cache entry "%s": %s'
+                     % (path, err))
+            continue
+        removed += 1
+    with SIZES_LOCK:
+        SIZES.pop(cache_dir(options), None)
+    info.log('INFO', 'panzer', 'removed %d entries from cache "%s"'
+             % (removed, cache_dir(options)))
+    return 0
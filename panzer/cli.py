@@ -1,10 +1,12 @@
 """ command line options for panzer """
 import argparse
+import functools
 import os
 import shutil
-import sys
-import tempfile
+from . import codec
 from . import const
+from . import info
+from . import util
 from . import version
 
 PANZER_DESCRIPTION = '''
@@ -22,8 +24,12 @@ This is free software; see the source for copying conditions. There is no
 warranty, not even for merchantability or fitness for a particular purpose.
 '''
 
-def parse_cli_options(options):
-    """ parse command line options """
+def parse_cli_options(options, args=None, stdin=None):
+    """
+    parse command line options
+    `args`:   list of arguments (default: `sys.argv[1:]`)
+    `stdin`:  bytes to use as stdin (default: read `sys.stdin`)
+    """
     #
     # disable pylint warnings:
     #     + Too many local variables (too-many-locals)
@@ -32,7 +38,7 @@ def parse_cli_options(options):
     # pylint: disable=R0914
     #
     # 1. Parse options specific to panzer
-    panzer_known, unknown = panzer_parse()
+    panzer_known, unknown = panzer_parse(args)
     # 2. Update options with panzer-specific values
     for field in panzer_known:
         val = panzer_known[field]
@@ -65,19 +71,12 @@ def parse_cli_options(options):
             # - html is default writer for unrecognised extensions
             options['pandoc']['write'] = 'html'
     # 5. Input from stdin
-    # - if one of the inputs is stdin then read from stdin now into
-    # - temp file, then replace '-'s in input filelist with reference to file
+    # - if one of the inputs is stdin then read from stdin now into an
+    # - in-memory file, then replace '-'s in input filelist with its path
+    # - (input is read more than once: to scan metadata, to fingerprint it
+    # - for the cache, and by pandoc)
     if '-' in options['pandoc']['input']:
-        # Read from stdin now into temp file in cwd
-        stdin_bytes = sys.stdin.buffer.read()
-        with tempfile.NamedTemporaryFile(prefix='__panzer-',
-                                         suffix='__',
-                                         dir=os.getcwd(),
-                                         delete=False) as temp_file:
-            temp_filename = os.path.join(os.getcwd(), temp_file.name)
-            options['panzer']['stdin_temp_file'] = temp_filename
-            temp_file.write(stdin_bytes)
-            temp_file.flush()
+        options['panzer']['stdin_temp_file'] = util.stdin_file(stdin)
         # Replace all reference to stdin in pandoc cli with temp file
         for index, val in enumerate(options['pandoc']['input']):
             if val == '-':
@@ -90,9 +89,9 @@ def parse_cli_options(options):
         # https://docs.python.org/dev/library/argparse.html#dest
         opt_name = str(opt).replace('_', '-')
         if opt_name not in const.PANDOC_OPT_PHASE:
-            print('ERROR:   '
-                  'do not know reader/writer type of command line option "--%s"'
-                  '---ignoring' % opt_name)
+            info.log('ERROR', 'panzer',
+                     'do not know reader/writer type of command line option "--%s"'
+                     '---ignoring' % opt_name)
             continue
         for phase in const.PANDOC_OPT_PHASE[opt_name]:
             options['pandoc']['options'][phase][opt_name] = opt_known[opt]
@@ -110,17 +109,24 @@ def parse_cli_options(options):
     # 7. print error messages for unknown options
     for opt in unknown:
         if opt in const.PANDOC_BAD_OPTS:
-            print('ERROR:   '
-                  'pandoc command line option "%s" not supported by panzer'
-                  '---ignoring' % opt)
+            info.log('ERROR', 'panzer',
+                     'pandoc command line option "%s" not supported by panzer'
+                     '---ignoring' % opt)
         else:
-            print('ERROR:   '
-                  'do not recognize command line option "%s"'
-                  '---ignoring' % opt)
+            info.log('ERROR', 'panzer',
+                     'do not recognize command line option "%s"'
+                     '---ignoring' % opt)
     return options
 
-def panzer_parse():
+def panzer_parse(args=None):
     """ return list of arguments recognised by panzer + unknowns """
+    panzer_known_raw, unknown = panzer_parser().parse_known_args(args)
+    panzer_known = vars(panzer_known_raw)
+    return (panzer_known, unknown)
+
+@functools.lru_cache(maxsize=None)
+def panzer_parser():
+    """ return parser for panzer's arguments (built once per process) """
     panzer_parser = argparse.ArgumentParser(
         description=PANZER_DESCRIPTION,
         epilog=PANZER_EPILOG,
@@ -144,12 +150,76 @@ def panzer_parse():
                                help='pandoc executable')
     panzer_parser.add_argument("---debug",
                                help='filename to write .log and .json debug files')
-    panzer_known_raw, unknown = panzer_parser.parse_known_args()
-    panzer_known = vars(panzer_known_raw)
-    return (panzer_known, unknown)
+    panzer_parser.add_argument("---cache-dir",
+                               help='directory for panzer cache files')
+    panzer_parser.add_argument("---no-cache",
+                               action='store_true',
+                               help='do not read or write the cache')
+    panzer_parser.add_argument("---rebuild-cache",
+                               action='store_true',
+                               help='ignore cached data and write fresh entries')
+    panzer_parser.add_argument("---cache-size",
+                               type=int,
+                               metavar='MB',
+                               help='size limit of cache, least recently used\n'
+                                    'entries removed first (default: %d)'
+                                    % const.CACHE_MAX_SIZE)
+    panzer_parser.add_argument("---clear-cache",
+                               action='store_true',
+                               help='remove all entries from cache and exit')
+    panzer_parser.add_argument("---cache-transforms",
+                               action='store_true',
+                               help='also cache results of applying styles')
+    panzer_parser.add_argument("---serve",
+                               metavar='SOCKET',
+                               help='run as daemon serving jobs on unix socket')
+    panzer_parser.add_argument("---connect",
+                               metavar='SOCKET',
+                               help='send job to panzer daemon on unix socket')
+    panzer_parser.add_argument("---workers",
+                               type=int,
+                               help='number of worker processes of daemon')
+    panzer_parser.add_argument("---watch",
+                               action='store_true',
+                               help='rebuild whenever inputs, styles, template\n'
+                                    'or run list executables change')
+    panzer_parser.add_argument("---pipeline",
+                               action='store_true',
+                               help='run json filters concurrently, each piped\n'
+                                    'into the next and the last into pandoc')
+    panzer_parser.add_argument("---json-backend",
+                               choices=['auto'] + codec.BACKENDS,
+                               help='json library used to encode and decode\n'
+                                    'documents (default: fastest installed)')
+    panzer_parser.add_argument("---manifest",
+                               action='store_true',
+                               help='skip build if nothing it depends on has\n'
+                                    'changed since last build')
+    panzer_parser.add_argument("---jobs",
+                               type=int,
+                               metavar='N',
+                               help='number of parallel scripts to run at once\n'
+                                    '(default: number of cpus)')
+    panzer_parser.add_argument("---message-path",
+                               action='store_true',
+                               help='give scripts the path of a file holding\n'
+                                    'the json message, instead of writing it\n'
+                                    'to their stdin')
+    panzer_parser.add_argument("---profile",
+                               metavar='FILE',
+                               help='write trace of where time is spent to\n'
+                                    'FILE (chrome trace event format)')
+    return panzer_parser
 
 def pandoc_parse(args):
     """ return list of arguments recognised by pandoc + unknowns """
+    pandoc_known_raw, unknown = pandoc_parser().parse_known_args(args)
+    pandoc_known = vars(pandoc_known_raw)
+    return (pandoc_known, unknown)
+
+@functools.lru_cache(maxsize=None)
+def pandoc_parser():
+    """ return parser for pandoc's main arguments (built once per process) """
     pandoc_parser = argparse.ArgumentParser(prog='pandoc')
     pandoc_parser.add_argument('input', nargs='*')
     pandoc_parser.add_argument("--read", "-r", "--from", "-f")
@@ -158,12 +228,17 @@ def pandoc_parse(args):
     pandoc_parser.add_argument("--template")
     pandoc_parser.add_argument("--filter", nargs=1, action='append')
     pandoc_parser.add_argument("--lua-filter", nargs=1, action='append')
-    pandoc_known_raw, unknown = pandoc_parser.parse_known_args(args)
-    pandoc_known = vars(pandoc_known_raw)
-    return (pandoc_known, unknown)
+    return pandoc_parser
 
 def pandoc_opt_parse(args):
     """ return list of pandoc command line options """
+    opt_known_raw, unknown = pandoc_opt_parser().parse_known_args(args)
+    opt_known = vars(opt_known_raw)
+    return (opt_known, unknown)
+
+@functools.lru_cache(maxsize=None)
+def pandoc_opt_parser():
+    """ return parser for pandoc's other options (built once per process) """
     opt_parser = argparse.ArgumentParser(prog='pandoc')
     # general options
     opt_parser.add_argument("--data-dir")
@@ -240,9 +315,7 @@ def pandoc_opt_parse(args):
     opt_parser.add_argument('--verbose', action='store_true')
     opt_parser.add_argument('--webtex')
     opt_parser.add_argument('--wrap')
-    opt_known_raw, unknown = opt_parser.parse_known_args(args)
-    opt_known = vars(opt_known_raw)
-    return (opt_known, unknown)
+    return opt_parser
 
 def set_quirky_dependencies(pandoc):
     """ Set defaults for pandoc options that are dependent in a quirky way,
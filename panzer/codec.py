@@ -0,0 +1,227 @@
+""" json codec: encode and decode documents as utf-8 bytes
+
+Uses the fastest json library installed (orjson, ujson or simdjson),
+falling back to the standard library's json. The library can be chosen
+with `---json-backend` or the `PANZER_JSON_BACKEND` environment variable.
+"""
+import gc
+import importlib
+import json
+import os
+from . import info
+
+# - backends in order of preference
+BACKENDS = ['orjson', 'ujson', 'simdjson', 'json']
+
+# - name of environment variable that selects backend
+ENV_VAR = 'PANZER_JSON_BACKEND'
+
+# - backend in use: name, encoder and decoder
+BACKEND = dict()
+
+def available():
+    """ return list of names of installed backends, in order of preference """
+    names = list()
+    for name in BACKENDS:
+        try:
+            importlib.import_module(name)
+            names.append(name)
+        except ImportError:
+            continue
+    return names
+
+def select(options):
+    """
+    select backend named by `---json-backend`, else by environment, else
+    the first one installed; returns name of backend selected
+    """
+    wanted = options['panzer']['json_backend'] \
+        or os.environ.get(ENV_VAR, '') \
+        or 'auto'
+    if BACKEND.get('wanted') == wanted:
+        return BACKEND['name']
+    installed = available()
+    if wanted == 'auto':
+        name = installed[0]
+    elif wanted in installed:
+        name = wanted
+    else:
+        info.log('WARNING', 'panzer', 'json backend "%s" not available---using "%s"'
+                 % (wanted, installed[0]))
+        name = installed[0]
+    module = importlib.import_module(name)
+    BACKEND.update(make_backend(name, module))
+    BACKEND['wanted'] = wanted
+    info.log('DEBUG', 'panzer', 'using json backend "%s"' % name)
+    return name
+
+def make_backend(name, module):
+    """ return dict with `name`, `dumps` and `loads` of backend `module` """
+    if name == 'orjson':
+        # - orjson works on bytes natively
+        dumps = module.dumps
+        loads = module.loads
+    elif name == 'ujson':
+        def dumps(data):
+            """ encode with ujson """
+            return module.dumps(data, ensure_ascii=False,
+                                escape_forward_slashes=False).encode('utf8')
+        loads = module.loads
+    elif name == 'simdjson':
+        # - simdjson only decodes
+        def dumps(data):
+            """ encode with stdlib json """
+            return json.dumps(data, ensure_ascii=False).encode('utf8')
+        loads = module.loads
+    else:
+        def dumps(data):
+            """ encode with stdlib json """
+            return json.dumps(data, ensure_ascii=False).encode('utf8')
+        loads = json.loads
+    return {'name': name, 'dumps': dumps, 'loads': loads}
+
+def dumps(data):
+    """ return `data` encoded as json in utf-8 bytes """
+    if not BACKEND:
+        BACKEND.update(make_backend('json', json))
+    return BACKEND['dumps'](data)
+
+def loads(data):
+    """
+    return object decoded from json in utf-8 bytes (or str) `data`
+    raises ValueError if `data` is not valid json
+    """
+    if not BACKEND:
+        BACKEND.update(make_backend('json', json))
+    # - decoded json has no reference cycles: do not let the garbage
+    # - collector scan the many objects created while decoding
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return BACKEND['loads'](data)
+    finally:
+        if enabled:
+            gc.enable()
+
+class LazyDocument(dict):
+    """
+    pandoc document whose `blocks` are kept as undecoded json bytes until
+    something asks for them (panzer itself only needs `meta`)
+    """
+    def __init__(self, fields, raw_blocks):
+        super().__init__(fields)
+        self.raw_blocks = raw_blocks
+
+    def __reduce__(self):
+        # - copy and pickle without decoding blocks
+        return (LazyDocument, (dict(dict.items(self)), self.raw_blocks))
+
+    def materialize(self):
+        """ decode `blocks` """
+        if self.raw_blocks is not None:
+            raw_blocks = self.raw_blocks
+            self.raw_blocks = None
+            dict.__setitem__(self, 'blocks', loads(raw_blocks))
+
+    def __missing__(self, key):
+        if key == 'blocks' and self.raw_blocks is not None:
+            self.materialize()
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == 'blocks' and self.raw_blocks is not None \
+            or dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.materialize()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        return dict.__len__(self) + (self.raw_blocks is not None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        self.materialize()
+        return dict.keys(self)
+
+    def values(self):
+        self.materialize()
+        return dict.values(self)
+
+    def items(self):
+        self.materialize()
+        return dict.items(self)
+
+def loads_document(data):
+    """
+    return pandoc document decoded from json in utf-8 bytes `data`,
+    decoding only its metadata if possible (see `LazyDocument`)
+    raises ValueError if `data` is not valid json
+    """
+    span = blocks_span(data)
+    if span is None:
+        return loads(data)
+    key_start, start, end = span
+    head = data[:key_start]
+    tail = data[end:]
+    # - join what is before and after `"blocks":[...]` into one object
+    head = head.rstrip(b' ')
+    if head.endswith(b','):
+        head = head[:-1]
+    if head.endswith(b'{') and tail.startswith(b','):
+        tail = tail[1:]
+    fields = loads(head + tail)
+    if not isinstance(fields, dict):
+        raise ValueError('json object expected')
+    return LazyDocument(fields, data[start:end])
+
+def blocks_span(data):
+    """
+    return (start of key, start, end) of the value of the top level
+    `"blocks"` field in json `data` of a pandoc document, or None if it
+    cannot be found without decoding
+    - handles compact json (as written by pandoc) and json with python's
+    - default separators (as written by filters using pandocfilters)
+    - blocks contain no objects with keys other than those of elements,
+    - and quotes inside strings are escaped, so the first `,"meta":` or
+    - `,"pandoc-api-version":` after the blocks start is where they end
+    """
+    if not isinstance(data, bytes) or not data.startswith(b'{'):
+        return None
+    space = b' ' if data.startswith(b'{"blocks": ') \
+        or data.find(b', "blocks": ') != -1 else b''
+    key = b'"blocks":' + space
+    if data.startswith(b'{' + key):
+        key_start = 1
+    else:
+        key_start = data.rfind(b',' + space + key)
+        if key_start == -1:
+            return None
+        key_start += 1 + len(space)
+    start = key_start + len(key)
+    if data[start:start + 1] != b'[':
+        return None
+    ends = [data.find(b',' + space + marker + space, start)
+            for marker in [b'"meta":', b'"pandoc-api-version":']]
+    ends = [end for end in ends if end != -1]
+    if ends:
+        end = min(ends)
+    else:
+        end = len(data.rstrip()) - 1
+    if data[end - 1:end] != b']':
+        return None
+    return key_start, start, end
+
+def dumps_document(ast):
+    """
+    return pandoc document `ast` encoded as json in utf-8 bytes, splicing
+    in the undecoded blocks of a `LazyDocument`
+    """
+    if not isinstance(ast, LazyDocument) or ast.raw_blocks is None:
+        return dumps(ast)
+    fields = dumps(dict(dict.items(ast)))
+    separator = b',' if len(fields) > 2 else b''
+    return fields[:-1] + separator + b'"blocks":' + ast.raw_blocks + b'}'
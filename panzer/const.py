@@ -8,8 +8,82 @@ REQUIRE_PANDOC_ATLEAST = "2.0"
 
 DEFAULT_SUPPORT_DIR = os.path.join(os.path.expanduser('~'), '.panzer')
 
+# subdirectory of support directory used for cache, unless ---cache-dir set
+CACHE_SUBDIR = 'cache'
+
+# size limit of cache in megabytes, unless ---cache-size set
+CACHE_MAX_SIZE = 256
+
+# fraction of size limit to which an oversized cache is pruned, so that
+# the next writes do not each prune it again
+CACHE_PRUNE_TO = 0.9
+
+# cache writes after which a process measures the cache again, to count
+# entries written by other processes
+CACHE_MEASURE_INTERVAL = 100
+
+# entries kept in memory by each process: style graphs, style definitions,
+# actions of in-process filters and results of applying styles
+MEMO_STYLE_GRAPHS = 64
+MEMO_STYLEDEFS = 16
+MEMO_FILTER_ACTIONS = 64
+MEMO_TRANSFORMS = 64
+
+# ---watch: seconds between checks for finished builds, seconds without
+# further changes before rebuilding, and seconds between polls when
+# inotify is not available
+WATCH_TICK = 0.1
+WATCH_DEBOUNCE = 0.2
+WATCH_POLL_INTERVAL = 0.5
+
+# format version of ---manifest files
+MANIFEST_VERSION = 1
+
+# persistent filter workers: protocol version, seconds to wait for a new
+# worker's handshake, for the reply to a job and for a worker to exit, and
+# jobs before restart
+FILTER_WORKER_PROTOCOL = 1
+FILTER_WORKER_START_TIMEOUT = 30
+FILTER_WORKER_JOB_TIMEOUT = 120
+FILTER_WORKER_STOP_TIMEOUT = 5
+FILTER_WORKER_MAX_JOBS = 100
+
+# readers, and input file extensions when no reader is given, whose yaml
+# metadata blocks are scanned for reader options before the full read
+PRESCAN_READERS = ['markdown']
+PRESCAN_EXTENSIONS = ['', '.md', '.markdown', '.mdown', '.mdwn', '.mkd',
+                      '.mkdn', '.txt', '.text']
+
+# readers, and input file extensions when no reader is given, whose reads
+# are cached: these cannot pull in other files (unlike e.g. latex's \input,
+# rst's `include` or org's `#+INCLUDE`), so a read depends only on the
+# input files and the files named by reader options
+AST_CACHE_READERS = ['markdown', 'markdown_strict', 'markdown_phpextra',
+                     'markdown_mmd', 'markdown_github', 'commonmark',
+                     'commonmark_x', 'gfm', 'html', 'json', 'native',
+                     'docx', 'odt', 'epub']
+AST_CACHE_EXTENSIONS = PRESCAN_EXTENSIONS + ['.html', '.htm', '.json',
+                                             '.native', '.docx', '.odt',
+                                             '.epub']
+
 ENCODING = 'utf8'
 
+# directory through which open file descriptors can be read as files: used
+# to give pandoc a path to the memfd holding panzer's stdin
+MEMFD_DIR = '/proc/self/fd'
+
+# bytes read at a time when copying output of a process to a stream
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# ---message-path: environment variable that gives scripts the path of the
+# file holding their json message
+MESSAGE_PATH_ENV_VAR = 'PANZER_JSON_MESSAGE'
+
+# lua filter run by pandoc writer in ---pipeline mode, to remove json
+# message that panzer would otherwise have removed from filters' output
+STRIP_MESSAGE_FILTER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'strip_message.lua')
+
 # keys to access type and content of metadata fields
 T = 't'
 C = 'c'
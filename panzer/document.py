@@ -1,15 +1,27 @@
 """ panzer document class and its methods """
-import json
+import concurrent.futures
+import copy
+import io
 import os
 import pandocfilters
-import subprocess
 import sys
+from . import cache
 from . import error
 from . import meta
+from . import pyfilter
+from . import trace
+from . import usage
 from . import util
+from . import version
+from . import worker
 from . import info
+from . import codec
 from . import const
 
+# - most recently used results of applying styles, keyed by style list,
+# - writer and style definitions (see `Document.style_transform`)
+TRANSFORMS = cache.Memo(const.MEMO_TRANSFORMS)
+
 class Document(object):
     """ representation of pandoc/panzer documents
     - ast:         pandoc abstract syntax tree of document
@@ -19,7 +31,10 @@ class Document(object):
     - runlist:     run list for document
     - options:     panzer and pandoc command line options
     - template:    template for document
-    - output:      string filled with output when processing complete
+    - stdout:      binary stream to which output for stdout is written
+    - write_failed: True if pandoc's writer failed
+    - message_cache: json encodings of parts of the json message, reused
+                   while the objects encoded are unchanged
     """
     #
     # disable pylint warnings:
@@ -30,15 +45,17 @@ class Document(object):
         """ new blank document """
         # - defaults
         if const.USE_OLD_API:
-            self.ast = const.EMPTY_DOCUMENT_OLDAPI
+            self.ast = copy.deepcopy(const.EMPTY_DOCUMENT_OLDAPI)
         else:
-            self.ast = const.EMPTY_DOCUMENT
+            self.ast = copy.deepcopy(const.EMPTY_DOCUMENT)
         self.style = list()
         self.stylefull = list()
         self.styledef = dict()
         self.runlist = list()
         self.template = None
-        self.output = None
+        self.stdout = sys.stdout.buffer
+        self.write_failed = False
+        self.message_cache = dict()
         self.options = {
             'panzer': {
                 'panzer_support'  : const.DEFAULT_SUPPORT_DIR,
@@ -46,7 +63,24 @@ class Document(object):
                 'debug'           : str(),
                 'quiet'           : False,
                 'strict'          : False,
-                'stdin_temp_file' : str()
+                'stdin_temp_file' : str(),
+                'pandoc_version'  : str(),
+                'cache_dir'       : str(),
+                'no_cache'        : False,
+                'rebuild_cache'   : False,
+                'cache_size'      : 0,
+                'clear_cache'     : False,
+                'cache_transforms': False,
+                'serve'           : str(),
+                'connect'         : str(),
+                'workers'         : 0,
+                'watch'           : False,
+                'manifest'        : False,
+                'pipeline'        : False,
+                'json_backend'    : str(),
+                'jobs'            : 0,
+                'message_path'    : False,
+                'profile'         : str()
             },
             'pandoc': {
                 'input'      : ['-'],
@@ -69,15 +103,15 @@ class Document(object):
         """
         # - defaults
         if const.USE_OLD_API:
-            self.ast = const.EMPTY_DOCUMENT_OLDAPI
+            self.ast = copy.deepcopy(const.EMPTY_DOCUMENT_OLDAPI)
         else:
-            self.ast = const.EMPTY_DOCUMENT
+            self.ast = copy.deepcopy(const.EMPTY_DOCUMENT)
         self.style = list()
         self.stylefull = list()
         self.styledef = dict()
         self.runlist = list()
         self.template = None
-        self.output = None
+        self.message_cache = dict()
 
     def populate(self, ast, global_styledef, local_styledef):
         """
@@ -89,7 +123,6 @@ class Document(object):
         remaining fields:
             `self.template` - set after 'transform' applied
             `self.runlist`  - set after 'transform' applied
-            `self.output`   - set after 'pandoc' applied
         """
         # - set self.ast:
         if ast:
@@ -298,6 +331,31 @@ class Document(object):
         if clear:
             self.set_metadata(metadata)
             return None
+        json_message = self.encode_message(metadata)
+        # - inject into metadata
+        content = {"json_message": {
+            "t": "MetaBlocks",
+            "c": [{"t": "CodeBlock", "c": [["", ["json"], []], json_message]}]}}
+        meta.set_content(metadata, 'panzer_reserved', content, 'MetaMap')
+        self.set_metadata(metadata)
+        # - return json_message
+        return json_message
+
+    def json_message_bytes(self):
+        """ as `json_message`, but return json message as utf-8 bytes """
+        self.json_message()
+        return self.message_cache['message'][0]
+
+    def encode_message(self, metadata):
+        """
+        return json message for document with `metadata`, as a string
+
+        The message is built from the json encoding of each of its fields.
+        The encodings of `metadata` and `self.styledef`, which can be large,
+        are reused for as long as these are the same objects (panzer, and
+        the output of filters, replace metadata rather than change it in
+        place). The other fields are small, and encoded every time.
+        """
         # - create a decrapified version of self.options
         # - remove stuff only of internal use to panzer
         options = dict()
@@ -307,27 +365,38 @@ class Document(object):
         del options['pandoc']['filter']
         del options['pandoc']['lua_filter']
         del options['pandoc']['mutable']
+        processes = usage.processes()
         # - build new json_message
-        data = [{'metadata':    metadata,
-                 'template':    self.template,
-                 'style':       self.style,
-                 'stylefull':   self.stylefull,
-                 'styledef':    self.styledef,
-                 'runlist':     self.runlist,
-                 'options':     options}]
-        json_message = json.dumps(data)
-        # - inject into metadata
-        content = {"json_message": {
-            "t": "MetaBlocks",
-            "c": [{"t": "CodeBlock", "c": [["", ["json"], []], json_message]}]}}
-        meta.set_content(metadata, 'panzer_reserved', content, 'MetaMap')
-        self.set_metadata(metadata)
-        # - return json_message
-        return json_message
+        fields = [('metadata',  metadata,       True),
+                  ('template',  self.template,  False),
+                  ('style',     self.style,     False),
+                  ('stylefull', self.stylefull, False),
+                  ('styledef',  self.styledef,  True),
+                  ('runlist',   self.runlist,   False),
+                  ('options',   options,        False),
+                  ('usage',     processes,      False)]
+        encoded = list()
+        for key, value, reuse in fields:
+            cached = self.message_cache.get(key)
+            if reuse and cached and cached[0] is value:
+                value_bytes = cached[1]
+            else:
+                value_bytes = codec.dumps(value)
+                if reuse:
+                    # - keep `value` alive, so that its id is not reused
+                    self.message_cache[key] = (value, value_bytes)
+            encoded.append(b'"' + key.encode(const.ENCODING) + b'":' + value_bytes)
+        message_bytes = b'[{' + b','.join(encoded) + b'}]'
+        # - decode only if message has changed
+        cached = self.message_cache.get('message')
+        if not cached or cached[0] != message_bytes:
+            cached = (message_bytes, message_bytes.decode(const.ENCODING))
+            self.message_cache['message'] = cached
+        return cached[1]
 
     def purge_style_fields(self):
         """ remove metadata fields from `self.ast` used to call panzer """
-        kill_list = const.RUNLIST_KIND
+        kill_list = list(const.RUNLIST_KIND)
         kill_list += ['style']
         kill_list += ['styledef']
         kill_list += ['template']
@@ -348,7 +417,7 @@ class Document(object):
             try:
                 self.ast[0]['unMeta'] = new_metadata
             except (IndexError, KeyError):
-                self.ast = const.EMPTY_DOCUMENT_OLDAPI
+                self.ast = copy.deepcopy(const.EMPTY_DOCUMENT_OLDAPI)
                 self.ast[0]['unMeta'] = new_metadata
         else:
             self.ast['meta'] = new_metadata
@@ -359,42 +428,29 @@ class Document(object):
         info.log('INFO', 'panzer', 'writer:')
         info.log('INFO', 'panzer', '  %s' % writer)
         # 1. Do transform
-        # - start with blank metadata
-        new_metadata = dict()
-        # - apply styles, first to last
-        for style in self.stylefull:
-            all_s = meta.get_nested_content(self.styledef, [style, 'all'], 'MetaMap')
-            new_metadata = meta.update_metadata(new_metadata, all_s)
-            self.apply_commandline(all_s)
-            cur_s = meta.get_nested_content(self.styledef, [style, writer], 'MetaMap')
-            new_metadata = meta.update_metadata(new_metadata, cur_s)
-            self.apply_commandline(cur_s)
+        # - start with result of applying styles, first to last
+        styled = self.style_transform(writer)
+        new_metadata = styled['metadata']
+        for commandline in styled['commandlines']:
+            self.options['pandoc']['options'] = \
+                meta.update_pandoc_options(self.options['pandoc']['options'],
+                                           commandline,
+                                           self.options['pandoc']['mutable'])
         # - add in document metadata in document
         indoc_data = self.get_metadata()
         # -- add items from additive fields in indoc metadata
         new_metadata = meta.update_additive_lists(new_metadata, indoc_data)
+        extended = list()
         for field in const.RUNLIST_KIND:
             if field in indoc_data:
+                extended.append(field)
                 del indoc_data[field]
         # -- add all other (non-additive) fields in
         new_metadata.update(indoc_data)
         # -- apply items from indoc `commandline` field
         self.apply_commandline(indoc_data)
-        # 2. Apply kill rules to trim run lists
-        for field in const.RUNLIST_KIND:
-            try:
-                original_list = meta.get_content(new_metadata, field, 'MetaList')
-                trimmed_list = meta.apply_kill_rules(original_list)
-                if trimmed_list:
-                    meta.set_content(new_metadata, field, trimmed_list, 'MetaList')
-                else:
-                    # if all items killed, delete field
-                    del new_metadata[field]
-            except error.MissingField:
-                continue
-            except error.WrongType as err:
-                info.log('WARNING', 'panzer', err)
-                continue
+        # 2. Apply kill rules to trim run lists extended by document
+        meta.trim_runlists(new_metadata, extended)
         # 3. Set template
         try:
             if meta.get_type(new_metadata, 'template') == 'MetaInlines':
@@ -415,6 +471,59 @@ class Document(object):
         # 4. Update document's metadata
         self.set_metadata(new_metadata)
 
+    def style_transform(self, writer):
+        """
+        return result of applying styles in `self.stylefull` for `writer`:
+            'metadata':     metadata set by styles, with kill rules applied
+                            to its run lists
+            'commandlines': pandoc options set by styles' `commandline`
+                            fields, in order of application
+        Results are kept in memory (and in panzer's cache if
+        ---cache-transforms is set), keyed by panzer's version and the style
+        list, writer and style definitions used, and reused by later
+        documents with the same styles; the log messages of making a
+        result are replayed when it is reused.
+        """
+        key = cache.make_key('transform', version.VERSION, self.stylefull,
+                             writer, self.styledef)
+        persist = self.options['panzer']['cache_transforms']
+        content = None
+        if not self.options['panzer']['rebuild_cache']:
+            content = TRANSFORMS.get(key)
+        if content is None and persist:
+            content = cache.read_bytes(self.options, 'transform', key)
+        if content is not None:
+            try:
+                result = codec.loads(content)
+                TRANSFORMS.put(key, content)
+                info.log('DEBUG', 'panzer', 'reusing transform of styles')
+                info.replay(result['log'])
+                return result
+            except (ValueError, KeyError):
+                info.log('DEBUG', 'panzer', 'cached transform corrupt---ignoring it')
+        with info.recording() as records:
+            new_metadata = dict()
+            commandlines = list()
+            for style in self.stylefull:
+                for branch in ['all', writer]:
+                    definition = meta.get_nested_content(self.styledef,
+                                                         [style, branch],
+                                                         'MetaMap')
+                    new_metadata = meta.update_metadata(new_metadata, definition)
+                    if 'commandline' in definition:
+                        commandline = meta.parse_commandline(definition)
+                        if commandline:
+                            commandlines.append(commandline)
+            meta.trim_runlists(new_metadata, const.RUNLIST_KIND)
+        result = {'metadata': new_metadata,
+                  'commandlines': commandlines,
+                  'log': records}
+        content = codec.dumps(result)
+        TRANSFORMS.put(key, content)
+        if persist:
+            cache.write_bytes(self.options, 'transform', key, content)
+        return result
+
     def run_scripts(self, kind, do_not_stop=False):
         """
         execute commands of type `kind` listed in `self.runlist`
@@ -426,32 +535,54 @@ class Document(object):
         if not to_run:
             return
         info.log('INFO', 'panzer', info.pretty_title(kind))
-        # - maximum number of executables to run
+        # - entries that may run concurrently
+        if [entry for entry in to_run if 'parallel' in entry or 'after' in entry]:
+            self.run_scripts_concurrently(kind, do_not_stop)
+            return
         for i, entry in enumerate(self.runlist):
             # - skip entries that are not of the right kind
             if entry['kind'] != kind:
                 continue
-            # - build the command to run
-            command = [entry['command']] + entry['arguments']
-            filename = os.path.basename(entry['command'])
-            info.log('INFO', 'panzer',
-                     info.pretty_runlist_entry(i,
-                                               len(self.runlist),
-                                               entry['command'],
-                                               entry['arguments']))
-            info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
-            # - run the command
-            stderr = str()
+            entry['status'] = const.RUNNING
+            # send panzer's json message to scripts via stdin
+            in_pipe_bytes = self.json_message_bytes()
+            self.run_script(i, entry, in_pipe_bytes, do_not_stop)
+
+    def run_script(self, i, entry, in_pipe_bytes, do_not_stop):
+        """
+        run script `entry` (number `i` of `self.runlist`), sending it json
+        message `in_pipe_bytes`; `do_not_stop` as for `run_scripts`
+        with ---message-path, the message is written to a temporary file
+        whose path is in the script's environment, instead of to its stdin
+        """
+        # - build the command to run
+        command = [entry['command']] + entry['arguments']
+        filename = os.path.basename(entry['command'])
+        info.log('INFO', 'panzer',
+                 info.pretty_runlist_entry(i,
+                                           len(self.runlist),
+                                           entry['command'],
+                                           entry['arguments']))
+        info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
+        # - run the command
+        stderr = str()
+        env = util.child_env(self.options)
+        message_path = str()
+        with trace.span(filename, entry['kind'], index=i,
+                        arguments=entry['arguments']) as details:
+            details['message bytes'] = len(in_pipe_bytes)
             try:
                 entry['status'] = const.RUNNING
-                process = subprocess.Popen(' '.join(command),
-                                           stdin=subprocess.PIPE,
-                                           stderr=subprocess.PIPE,
-                                           shell=True)
-                # send panzer's json message to scripts via stdin
-                in_pipe = self.json_message()
-                in_pipe_bytes = in_pipe.encode(const.ENCODING)
-                stderr_bytes = process.communicate(input=in_pipe_bytes)[1]
+                if self.options['panzer']['message_path']:
+                    message_path = util.write_temp_file(in_pipe_bytes, 'message-', '.json')
+                    env[const.MESSAGE_PATH_ENV_VAR] = message_path
+                    in_pipe_bytes = None
+                _, stderr_bytes, _, entry['usage'] = \
+                    util.run_process(' '.join(command),
+                                     in_pipe_bytes,
+                                     stdout=None,
+                                     env=env,
+                                     pass_fds=util.stdin_fds(self.options))
                 entry['status'] = const.DONE
                 stderr = stderr_bytes.decode(const.ENCODING)
                 if stderr:
@@ -459,7 +590,6 @@ class Document(object):
             except OSError as err:
                 entry['status'] = const.FAILED
                 info.log('ERROR', filename, err)
-                continue
             except Exception as err:        # pylint: disable=W0703
                 # if do_not_stop: always run next script
                 # disable pylint warnings:
@@ -467,12 +597,98 @@ class Document(object):
                 entry['status'] = const.FAILED
                 if do_not_stop:
                     info.log('ERROR', filename, err)
-                    continue
                 else:
                     raise
             finally:
+                details['status'] = entry['status']
+                if message_path:
+                    os.remove(message_path)
                 info.log_stderr(stderr, filename)
 
+    def run_scripts_concurrently(self, kind, do_not_stop):
+        """
+        execute commands of type `kind` listed in `self.runlist`, running
+        an entry as soon as the entries it depends on have finished (see
+        `script_dependencies`), with at most ---jobs entries at once
+        log messages of each entry are printed together when it finishes
+        `do_not_stop`: as for `run_scripts`, but all entries are run before
+                       the first error is raised
+        """
+        entries = [i for i, entry in enumerate(self.runlist) if entry['kind'] == kind]
+        dependencies = self.script_dependencies(entries)
+        jobs = self.options['panzer']['jobs'] or os.cpu_count() or 1
+        pending = list(entries)
+        running = dict()
+        finished = set()
+        first_error = None
+        state = util.thread_state()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            while pending or running:
+                # - start entries whose dependencies have all finished
+                for i in list(pending):
+                    if first_error and not do_not_stop:
+                        pending = list()
+                        break
+                    if len(running) >= jobs:
+                        break
+                    if dependencies[i] <= finished:
+                        pending.remove(i)
+                        entry = self.runlist[i]
+                        entry['status'] = const.RUNNING
+                        in_pipe_bytes = self.json_message_bytes()
+                        future = pool.submit(util.capture_call, self.run_script,
+                                             [i, entry, in_pipe_bytes, do_not_stop],
+                                             state)
+                        running[future] = i
+                if not running:
+                    break
+                done = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+                for future in sorted(done, key=lambda f: running[f]):
+                    finished.add(running.pop(future))
+                    err, records = future.result()[1:]
+                    try:
+                        info.replay(records)
+                        if err:
+                            raise err
+                    except Exception as replay_err:    # pylint: disable=W0703
+                        first_error = first_error or replay_err
+        if first_error:
+            raise first_error
+
+    def script_dependencies(self, entries):
+        """
+        return dict mapping each index in `entries` (indices of scripts of
+        one kind in `self.runlist`) to set of indices it must wait for:
+            - `after: NAMES`: the earlier entries with those names
+            - `parallel: true`: every entry up to the last plain entry
+            - otherwise: every earlier entry
+        """
+        dependencies = dict()
+        names = dict()
+        earlier = set()
+        barrier = set()
+        for i in entries:
+            entry = self.runlist[i]
+            if 'after' in entry:
+                dependencies[i] = set()
+                for name in entry['after']:
+                    if name in names:
+                        dependencies[i].add(names[name])
+                    else:
+                        info.log('ERROR', 'panzer', '"%s": no earlier entry named '
+                                 '"%s" to run after---ignoring it'
+                                 % (entry['command'], name))
+            elif entry.get('parallel'):
+                dependencies[i] = set(barrier)
+            else:
+                dependencies[i] = set(earlier)
+                barrier = earlier | {i}
+            earlier.add(i)
+            if 'name' in entry:
+                names[entry['name']] = i
+        return dependencies
+
     def jsonfilter(self):
         """
         pipe through external command listed in filters
@@ -481,60 +697,150 @@ class Document(object):
         if not to_run:
             return
         info.log('INFO', 'panzer', info.pretty_title('filter'))
+        # - filters are run together with pandoc writer
+        if self.pipelined():
+            for i, entry in enumerate(self.runlist):
+                if entry['kind'] == 'filter':
+                    info.log('INFO', 'panzer',
+                             info.pretty_runlist_entry(i,
+                                                       len(self.runlist),
+                                                       entry['command'],
+                                                       entry['arguments']))
+            info.log('INFO', 'panzer', 'run in pipeline with pandoc write')
+            return
         # Run commands
         for i, entry in enumerate(self.runlist):
             if entry['kind'] != 'filter':
                 continue
-            # - add debugging info
-            command = [entry['command']] + entry['arguments']
-            filename = os.path.basename(entry['command'])
-            info.log('INFO', 'panzer',
-                     info.pretty_runlist_entry(i,
-                                               len(self.runlist),
-                                               entry['command'],
-                                               entry['arguments']))
-            info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
-            # - run the command and log any errors
-            stderr = str()
-            try:
-                entry['status'] = const.RUNNING
-                self.json_message()
-                # Set up incoming pipe
-                in_pipe = json.dumps(self.ast)
-                # Set up outgoing pipe in case of failure
-                out_pipe = in_pipe
-                process = subprocess.Popen(' '.join(command),
-                                           stderr=subprocess.PIPE,
-                                           stdin=subprocess.PIPE,
-                                           stdout=subprocess.PIPE,
-                                           shell=True)
-                in_pipe_bytes = in_pipe.encode(const.ENCODING)
-                out_pipe_bytes, stderr_bytes = \
-                    process.communicate(input=in_pipe_bytes)
-                entry['status'] = const.DONE
-                out_pipe = out_pipe_bytes.decode(const.ENCODING)
-                stderr = stderr_bytes.decode(const.ENCODING)
-                if stderr:
-                    entry['stderr'] = info.decode_stderr_json(stderr)
-            except OSError as err:
-                entry['status'] = const.FAILED
-                info.log('ERROR', filename, err)
-                continue
-            except Exception:
-                entry['status'] = const.FAILED
-                raise
-            finally:
-                # remove embedded json message
-                info.log_stderr(stderr, filename)
-            # 4. Update document's data with output from commands
-            try:
-                self.ast = json.loads(out_pipe)
-                self.json_message(clear=True)
-            except ValueError:
-                info.log('ERROR', 'panzer',
-                         'failed to receive json object from filter'
-                         '---skipping filter')
-                continue
+            with trace.span(os.path.basename(entry['command']), 'filter',
+                            index=i, arguments=entry['arguments']) as details:
+                self.run_filter(i, entry)
+                details['status'] = entry['status']
+
+    def run_filter(self, i, entry):
+        """ run json filter `entry` (number `i` of `self.runlist`) on `self.ast` """
+        # - add debugging info
+        command = [entry['command']] + entry['arguments']
+        filename = os.path.basename(entry['command'])
+        info.log('INFO', 'panzer',
+                 info.pretty_runlist_entry(i,
+                                           len(self.runlist),
+                                           entry['command'],
+                                           entry['arguments']))
+        # - python filter run inside panzer's process
+        if entry.get('inprocess'):
+            actions = pyfilter.load_actions(entry, self.options)
+            if actions is not None:
+                info.log('DEBUG', 'panzer', 'run "%s" in process'
+                         % ' '.join(command))
+                self.inprocess_filter(entry, actions)
+                return
+        # - filter kept running between documents
+        if entry.get('persistent'):
+            info.log('DEBUG', 'panzer', 'run "%s" as persistent worker'
+                     % ' '.join(command))
+            if self.persistent_filter(entry):
+                return
+        info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
+        # - run the command and log any errors
+        stderr = str()
+        try:
+            entry['status'] = const.RUNNING
+            self.json_message()
+            # Set up incoming pipe
+            with trace.span('encode', 'json') as details:
+                in_pipe_bytes = codec.dumps_document(self.ast)
+                details['bytes'] = len(in_pipe_bytes)
+            out_pipe_bytes, stderr_bytes, _, entry['usage'] = \
+                util.run_process(' '.join(command),
+                                 in_pipe_bytes,
+                                 env=util.child_env(self.options),
+                                 pass_fds=util.stdin_fds(self.options))
+            entry['status'] = const.DONE
+            stderr = stderr_bytes.decode(const.ENCODING)
+            if stderr:
+                entry['stderr'] = info.decode_stderr_json(stderr)
+        except OSError as err:
+            entry['status'] = const.FAILED
+            info.log('ERROR', filename, err)
+            return
+        except Exception:
+            entry['status'] = const.FAILED
+            raise
+        finally:
+            # remove embedded json message
+            info.log_stderr(stderr, filename)
+        # 4. Update document's data with output from commands
+        try:
+            with trace.span('decode', 'json', bytes=len(out_pipe_bytes)):
+                self.ast = codec.loads_document(out_pipe_bytes)
+            self.json_message(clear=True)
+        except ValueError:
+            info.log('ERROR', 'panzer',
+                     'failed to receive json object from filter'
+                     '---skipping filter')
+
+    def inprocess_filter(self, entry, actions):
+        """ apply pandocfilters `actions` of filter `entry` to `self.ast` """
+        filename = os.path.basename(entry['command'])
+        entry['status'] = const.RUNNING
+        self.json_message()
+        stderr = io.StringIO()
+        try:
+            self.ast = pyfilter.apply(self.ast, actions, entry, self.options, stderr)
+            entry['status'] = const.DONE
+        except Exception as err:        # pylint: disable=W0703
+            # - as for external filters, a failed filter is skipped
+            entry['status'] = const.FAILED
+            info.log('ERROR', filename, repr(err))
+            info.log('ERROR', 'panzer', 'filter failed---skipping filter')
+        finally:
+            if stderr.getvalue():
+                entry['stderr'] = info.decode_stderr_json(stderr.getvalue())
+            info.log_stderr(stderr.getvalue(), filename)
+            self.json_message(clear=True)
+
+    def persistent_filter(self, entry):
+        """
+        run filter `entry` on `self.ast` with a persistent worker
+        returns False if worker cannot be used
+        """
+        filename = os.path.basename(entry['command'])
+        entry['status'] = const.RUNNING
+        self.json_message()
+        stderr = str()
+        try:
+            out_bytes, stderr = worker.run(entry, codec.dumps_document(self.ast),
+                                           self.options)
+        except (OSError, worker.WorkerError) as err:
+            entry['status'] = const.QUEUED
+            self.json_message(clear=True)
+            info.log('WARNING', 'panzer', 'cannot run "%s" as worker (%s)---running '
+                     'it as external filter' % (filename, err))
+            return False
+        entry['status'] = const.DONE
+        if stderr:
+            entry['stderr'] = info.decode_stderr_json(stderr)
+        info.log_stderr(stderr, filename)
+        try:
+            self.ast = codec.loads_document(out_bytes)
+        except ValueError:
+            info.log('ERROR', 'panzer',
+                     'failed to receive json object from filter'
+                     '---skipping filter')
+        self.json_message(clear=True)
+        return True
+
+    def pipelined(self):
+        """
+        return True if json filters are to run in a pipeline with pandoc
+        writer (---pipeline set, and no filter runs inside panzer's process
+        or as a persistent worker)
+        """
+        return self.options['panzer']['pipeline'] \
+            and not [entry for entry in self.runlist
+                     if entry['kind'] == 'filter'
+                     and (entry.get('inprocess') or entry.get('persistent'))]
 
     def pandoc(self):
         """
@@ -544,13 +850,32 @@ class Document(object):
         stout. Exception is when the output file has .pdf extension or a binary
         writer selected. Then, output is simply the binary file that panzer
         does not process further, and internal document not updated by pandoc.
+
+        Postprocessors run in the same pipeline: pandoc's stdout is piped
+        through them, and the last one writes to the output file (or stdout).
+
+        The output file is written under a temporary name, and replaces the
+        previous output only if pandoc and the whole pipeline succeed.
         """
+        postprocessors = self.streamed_postprocessors()
+        output = self.options['pandoc']['output']
+        temp_output = None
+        if output != '-':
+            try:
+                temp_output = util.output_temp_file(output)
+            except OSError as err:
+                self.write_failed = True
+                info.log('ERROR', 'panzer', 'cannot write "%s": %s' % (output, err))
+                return
         # 1. Build pandoc command
         command = [self.options['panzer']['pandoc']]
         command += ['-']
         command += ['--read', 'json']
         command += ['--write', self.options['pandoc']['write']]
-        command += ['--output', self.options['pandoc']['output']]
+        if postprocessors:
+            command += ['--output', '-']
+        else:
+            command += ['--output', temp_output or output]
         # - template specified on cli has precedence
         if self.options['pandoc']['template']:
             command += ['--template=%s' % self.options['pandoc']['template']]
@@ -571,9 +896,24 @@ class Document(object):
                                                len(self.runlist),
                                                entry['command'],
                                                entry['arguments']))
+        # - ---pipeline: json filters feed straight into pandoc
+        filters = list()
+        if self.pipelined():
+            filters = [entry for entry in self.runlist
+                       if entry['kind'] == 'filter']
+        if filters:
+            command += ['--lua-filter', const.STRIP_MESSAGE_FILTER]
         # 2. Prefill input and output pipes
-        in_pipe = json.dumps(self.ast)
-        out_pipe = str()
+        for entry in filters:
+            entry['status'] = const.RUNNING
+        with trace.span('encode', 'json') as details:
+            if filters:
+                self.json_message()
+                in_pipe_bytes = codec.dumps_document(self.ast)
+                self.json_message(clear=True)
+            else:
+                in_pipe_bytes = codec.dumps_document(self.ast)
+            details['bytes'] = len(in_pipe_bytes)
         stderr = str()
         # 3. Run pandoc command
         if opts or luaopts:
@@ -581,112 +921,141 @@ class Document(object):
             info.log('INFO', 'panzer', info.pretty_list(opts + luaopts, separator=' '))
         else:
             info.log('INFO', 'panzer', 'running')
+        filter_commands = [' '.join([entry['command']] + entry['arguments'])
+                           for entry in filters]
+        postprocess_commands = [' '.join([entry['command']] + entry['arguments'])
+                                for entry in postprocessors]
+        for filter_command in filter_commands:
+            info.log('DEBUG', 'panzer', 'run "%s" |' % filter_command)
         info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
+        for postprocess_command in postprocess_commands:
+            info.log('DEBUG', 'panzer', '| run "%s"' % postprocess_command)
+        for entry in postprocessors:
+            entry['status'] = const.RUNNING
+        # - output is streamed to its destination as it is written: last
+        # - command writes straight to output file or stdout (or is copied
+        # - to stdout in chunks, if stdout is not a file)
+        destination = None
+        returncodes = list()
         try:
-            info.time_stamp('ready to do popen')
-            process = subprocess.Popen(command,
-                                       stderr=subprocess.PIPE,
-                                       stdin=subprocess.PIPE,
-                                       stdout=subprocess.PIPE)
-            info.time_stamp('popen done')
-            in_pipe_bytes = in_pipe.encode(const.ENCODING)
-            out_pipe_bytes, stderr_bytes = \
-                process.communicate(input=in_pipe_bytes)
-            info.time_stamp('communicate done')
-            out_pipe = out_pipe_bytes.decode(const.ENCODING)
-            stderr = stderr_bytes.decode(const.ENCODING)
+            if output == '-':
+                self.stdout.flush()
+                destination = self.stdout
+            elif postprocessors:
+                destination = open(temp_output, 'wb')
+            commands = filter_commands + [command] + postprocess_commands
+            with trace.span('pipeline', 'pandoc', commands=len(commands)):
+                stderrs_bytes, returncodes, usages = \
+                    util.run_pipeline(commands,
+                                      in_pipe_bytes,
+                                      env=util.child_env(self.options),
+                                      stdout=destination,
+                                      pass_fds=util.stdin_fds(self.options))
+            index = len(filters)
+            for entry, entry_usage in zip(filters + postprocessors,
+                                          usages[:index] + usages[index + 1:]):
+                entry['usage'] = entry_usage
+            stderr = stderrs_bytes[index].decode(const.ENCODING)
+            if returncodes[index] != 0:
+                self.write_failed = True
+                info.log_stderr(stderr)
+                stderr = str()
+                info.log('ERROR', 'pandoc', 'exited with status %d' % returncodes[index])
+            self.pipeline_results(filters, stderrs_bytes[:index], returncodes[:index])
+            if postprocessors:
+                info.log_stderr(stderr)
+                stderr = str()
+                self.postprocess_results(postprocessors, stderrs_bytes[index + 1:],
+                                         returncodes[index + 1:])
         except OSError as err:
+            self.write_failed = True
+            for entry in filters + postprocessors:
+                entry['status'] = const.FAILED
             info.log('ERROR', 'pandoc', err)
         finally:
+            if destination is self.stdout:
+                self.stdout.flush()
+            elif destination is not None:
+                destination.close()
             info.log_stderr(stderr)
-            sys.stdout.buffer.write(out_pipe_bytes)
-            sys.stdout.flush()
+        # - replace previous output only if every command succeeded
+        if temp_output is not None:
+            if returncodes and not any(returncodes):
+                try:
+                    util.replace_output(temp_output, output)
+                    temp_output = None
+                except OSError as err:
+                    self.write_failed = True
+                    info.log('ERROR', 'panzer', 'cannot write "%s": %s'
+                             % (output, err))
+            else:
+                info.log('WARNING', 'panzer', 'output "%s" left unchanged'
+                         % output)
+            if temp_output is not None and os.path.exists(temp_output):
+                os.remove(temp_output)
         # mark all lua filters as 'done'
         for entry in self.runlist:
             if entry['kind'] == 'lua-filter':
                 entry['status'] = const.DONE
-        # 4. Capture output of pandoc if it is to stdout
+
+    def pipeline_results(self, entries, stderrs_bytes, returncodes):
+        """
+        update run list `entries` run in pipeline with pandoc, given their
+        stderr and return codes, and log their messages
+        """
+        for entry, stderr_bytes, returncode in zip(entries, stderrs_bytes, returncodes):
+            filename = os.path.basename(entry['command'])
+            stderr = stderr_bytes.decode(const.ENCODING)
+            if stderr:
+                entry['stderr'] = info.decode_stderr_json(stderr)
+            info.log_stderr(stderr, filename)
+            if returncode == 0:
+                entry['status'] = const.DONE
+            else:
+                entry['status'] = const.FAILED
+                info.log('ERROR', filename, 'exited with status %d' % returncode)
+
+    def streamed_postprocessors(self):
+        """
+        return postprocessors to run in pipeline after pandoc's writer
+        (none if the output is binary, as postprocessors work on text)
+        """
+        to_run = [entry for entry in self.runlist if entry['kind'] == 'postprocess']
         if self.options['pandoc']['pdf_output'] \
         or self.options['pandoc']['write'] in const.BINARY_WRITERS:
-            # do nothing with a binary output
-            pass
-        elif self.options['pandoc']['output'] == '-':
-            self.output = out_pipe
+            return list()
+        return to_run
 
-    def postprocess(self):
+    def postprocess_results(self, postprocessors, stderrs_bytes, returncodes):
         """
-        postprocess through external command listed in 'postprocess'
+        update run list entries of `postprocessors` run in pipeline after
+        pandoc, given their stderr and return codes, and log their messages
         """
-        to_run = [entry for entry in self.runlist if entry['kind'] == 'postprocess']
-        if not to_run:
-            return
         info.log('INFO', 'panzer', info.pretty_title('postprocess'))
-        # prepare the input
-        # case 1: pandoc output written to stdout
-        if self.options['pandoc']['output'] == '-':
-            in_pipe = self.output
-            info.log('INFO', 'panzer', "input read from pandoc's stdout")
-        # case 2: pandoc output written to file
-        else:
-            with open(self.options['pandoc']['output'], 'r', encoding=const.ENCODING) as fp:
-                in_pipe = fp.read()
-            info.log('INFO', 'panzer', 'input read from "%s"' % self.options['pandoc']['output'])
-        # Run commands
-        for i, entry in enumerate(self.runlist):
-            if entry['kind'] != 'postprocess':
-                continue
-            # - add debugging info
-            command = [entry['command']] + entry['arguments']
-            filename = os.path.basename(entry['command'])
+        info.log('INFO', 'panzer', "input read from pandoc's stdout")
+        for entry, stderr_bytes, returncode in zip(postprocessors, stderrs_bytes, returncodes):
             info.log('INFO', 'panzer',
-                     info.pretty_runlist_entry(i,
+                     info.pretty_runlist_entry(self.runlist.index(entry),
                                                len(self.runlist),
                                                entry['command'],
                                                entry['arguments']))
-            info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
-            # - run the command and log any errors
-            stderr = str()
-            try:
-                entry['status'] = const.RUNNING
-                # Set up outgoing pipe in case of failure
-                out_pipe = in_pipe
-                process = subprocess.Popen(' '.join(command),
-                                           stderr=subprocess.PIPE,
-                                           stdin=subprocess.PIPE,
-                                           stdout=subprocess.PIPE,
-                                           shell=True)
-                in_pipe_bytes = in_pipe.encode(const.ENCODING)
-                out_pipe_bytes, stderr_bytes = \
-                    process.communicate(input=in_pipe_bytes)
-                entry['status'] = const.DONE
-                out_pipe = out_pipe_bytes.decode(const.ENCODING)
-                stderr = stderr_bytes.decode(const.ENCODING)
-                if stderr:
-                    entry['stderr'] = info.decode_stderr_json(stderr)
-            except OSError as err:
-                entry['status'] = const.FAILED
-                info.log('ERROR', filename, err)
-                continue
-            except Exception:
-                entry['status'] = const.FAILED
-                raise
-            finally:
-                info.log_stderr(stderr, filename)
-            self.output = out_pipe
-            in_pipe = out_pipe
-        # 4. write final output
-        # case 1: stdout as output
+            self.pipeline_results([entry], [stderr_bytes], [returncode])
         if self.options['pandoc']['output'] == '-':
-            sys.stdout.buffer.write(out_pipe_bytes)
-            sys.stdout.flush()
             info.log('INFO', 'panzer', 'output written to stdout')
-            info.log('DEBUG', 'panzer', 'output written stdout by panzer')
-        # case 2: output to file
         else:
-            with open(self.options['pandoc']['output'], 'w',
-                      encoding=const.ENCODING) as output_file:
-                output_file.write(out_pipe)
-                output_file.flush()
             info.log('INFO', 'panzer', 'output written to "%s"'
                      % self.options['pandoc']['output'])
 
+    def postprocess(self):
+        """
+        postprocess through external command listed in 'postprocess'
+
+        Postprocessors that can run are run by `pandoc`, in a pipeline after
+        pandoc's writer. Binary output cannot be postprocessed.
+        """
+        to_run = [entry for entry in self.runlist if entry['kind'] == 'postprocess']
+        if not to_run or self.streamed_postprocessors():
+            return
+        info.log('INFO', 'panzer', info.pretty_title('postprocess'))
+        info.log('WARNING', 'panzer', 'cannot postprocess binary output---'
+                 'skipping postprocessors')
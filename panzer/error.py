@@ -28,6 +28,10 @@ class WrongType(PanzerError):
     """ looked for value of a type, encountered different type """
     pass
 
+class StyleCycleError(PanzerError):
+    """ style definitions in which a style is its own ancestor """
+    pass
+
 class InternalError(PanzerError):
     """ function invoked with invalid parameters """
     pass
@@ -1,8 +1,11 @@
 """ functions for logging and printing info """
+import contextlib
 import json
 import logging
 import logging.config
 import os
+import sys
+import threading
 import time
 from . import const
 from . import error
@@ -17,6 +20,9 @@ LEVELS = {
     'NOTSET'   : logging.NOTSET
 }
 
+# - per-thread buffer of log messages (see `start_capture`)
+BUFFER = threading.local()
+
 def start_logger(options):
     """ start the logger """
     # - default configuration
@@ -81,6 +87,19 @@ def start_logger(options):
 
 def log(level_str, sender, message):
     """ send a log message """
+    # - copy message to any recordings of current thread (see `recording`)
+    for records in getattr(BUFFER, 'recorders', ()):
+        records.append((level_str, sender, str(message)))
+    # - if capturing messages of current thread, buffer message for later
+    records = getattr(BUFFER, 'records', None)
+    if records is not None:
+        if BUFFER.quiet and LEVELS.get(level_str, LEVELS['ERROR']) < LEVELS['WARNING']:
+            return
+        records.append((level_str, sender, str(message)))
+        if BUFFER.strict and (level_str == 'ERROR' or level_str == 'CRITICAL'):
+            BUFFER.strict = False
+            raise error.StrictModeError
+        return
     my_logger = logging.getLogger(__name__)
     # set strict_mode to default value, if not already set
     if not hasattr(log, "strict_mode"):
@@ -116,19 +135,68 @@ def log(level_str, sender, message):
         log.strict_mode = False
         raise error.StrictModeError
 
+def start_capture(strict=False):
+    """
+    buffer log messages sent from the current thread instead of logging them
+    (used to keep log output in order when work is done concurrently, and
+    to collect log messages when panzer is used as a library)
+    `strict`: raise `StrictModeError` if an error is logged to the buffer
+    captures can be nested: `stop_capture` resumes the enclosing capture
+    """
+    if getattr(BUFFER, 'records', None) is not None:
+        if not hasattr(BUFFER, 'enclosing'):
+            BUFFER.enclosing = list()
+        BUFFER.enclosing.append((BUFFER.records, BUFFER.strict, BUFFER.quiet))
+    BUFFER.records = list()
+    BUFFER.strict = strict
+    BUFFER.quiet = False
+
+def stop_capture():
+    """ stop buffering log messages of current thread and return buffer """
+    records = BUFFER.records
+    del BUFFER.records
+    if getattr(BUFFER, 'enclosing', None):
+        BUFFER.records, BUFFER.strict, BUFFER.quiet = BUFFER.enclosing.pop()
+    return records
+
+@contextlib.contextmanager
+def recording():
+    """
+    record log messages sent from the current thread in the body of the
+    `with` statement, which are also logged as usual; yields the list of
+    records, which `replay` can log again later
+    """
+    records = list()
+    if not hasattr(BUFFER, 'recorders'):
+        BUFFER.recorders = list()
+    BUFFER.recorders.append(records)
+    try:
+        yield records
+    finally:
+        BUFFER.recorders.pop()
+
+def replay(records):
+    """ log messages in buffer `records` """
+    for level_str, sender, message in records:
+        log(level_str, sender, message)
+
 def go_quiet():
     """ force logging level to be --quiet """
+    if getattr(BUFFER, 'records', None) is not None:
+        BUFFER.quiet = True
+        return
     my_logger = logging.getLogger(__name__)
     my_logger.setLevel(LEVELS['WARNING'])
 
 def go_loud(options):
     """ return logging level to that set in options """
+    if getattr(BUFFER, 'records', None) is not None:
+        BUFFER.quiet = options['panzer']['quiet']
+        return
+    # - console handler's level already reflects ---quiet; the logger
+    # - itself passes everything on, so that ---debug's log file is complete
     my_logger = logging.getLogger(__name__)
-    if options['panzer']['quiet']:
-        verbosity_level = 'WARNING'
-    else:
-        verbosity_level = 'INFO'
-    my_logger.setLevel(LEVELS[verbosity_level])
+    my_logger.setLevel(LEVELS['DEBUG'])
 
 def decode_stderr_json(stderr):
     """ return a list of decoded json messages in stderr """
@@ -286,5 +354,6 @@ def time_stamp(text):
     else:
         now_str += ' ' * 12
     time_stamp.last = now
-    print(now_str)
+    # - stdout may be carrying the output document
+    print(now_str, file=sys.stderr)
 
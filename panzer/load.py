@@ -1,12 +1,16 @@
 """ loading documents into panzer """
 
+import copy
 import os
-import json
-import subprocess
+import re
+from . import cache
+from . import codec
 from . import error
 from . import info
 from . import const
 from . import meta
+from . import trace
+from . import util
 
 def load(options):
     """ return ast from running pandoc on input documents """
@@ -20,33 +24,81 @@ def load(options):
     command += opts
     info.log('INFO', 'panzer', info.pretty_title('pandoc read'))
     info.log('DEBUG', 'panzer', 'loading source document(s)')
+    # 2. Use cached read if sources and reader settings are unchanged
+    key = ast_cache_key(options, opts)
+    if key:
+        cached = cache.read_bytes(options, 'ast', key)
+        if cached is not None:
+            info.log('INFO', 'panzer', 'unchanged---using cached read')
+            try:
+                return codec.loads_document(cached)
+            except ValueError:
+                info.log('DEBUG', 'panzer', 'cached read corrupt---ignoring it')
     info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
     if opts:
         info.log('INFO', 'panzer', 'pandoc reading with options:')
         info.log('INFO', 'panzer', info.pretty_list(opts, separator=' '))
     else:
         info.log('INFO', 'panzer', 'running')
-    out_pipe = str()
+    out_pipe_bytes = bytes()
     stderr = str()
     ast = None
+    returncode = None
     try:
-        process = subprocess.Popen(command,
-                                   stderr=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
-        out_pipe_bytes, stderr_bytes = process.communicate()
-        out_pipe = out_pipe_bytes.decode(const.ENCODING)
+        out_pipe_bytes, stderr_bytes, returncode, _ = \
+            util.run_process(command, None, pass_fds=util.stdin_fds(options))
         stderr = stderr_bytes.decode(const.ENCODING)
     except OSError as err:
         info.log('ERROR', 'pandoc', err)
     finally:
         info.log_stderr(stderr)
     try:
-        ast = json.loads(out_pipe)
+        with trace.span('decode', 'json', bytes=len(out_pipe_bytes)):
+            ast = codec.loads_document(out_pipe_bytes)
     except ValueError:
         raise error.BadASTError('failed to receive valid '
                                 'json object from pandoc')
+    if key and returncode == 0:
+        cache.write_bytes(options, 'ast', key, out_pipe_bytes)
     return ast
 
+def ast_cache_key(options, opts):
+    """
+    return key of cached read of input documents with reader options
+    `opts`, or None if the read cannot be cached
+    """
+    if options['panzer']['no_cache']:
+        return None
+    # - reader may include files that panzer does not know of
+    if not uses_reader(options, const.AST_CACHE_READERS,
+                       const.AST_CACHE_EXTENSIONS):
+        return None
+    # - reader writes media files to disk: must run each time
+    if options['pandoc']['options']['r'].get('extract-media'):
+        return None
+    try:
+        # - stdin is buffered to a file with a random name
+        sources = [['-' if name == options['panzer']['stdin_temp_file']
+                    else name,
+                    cache.file_digest(name)]
+                   for name in options['pandoc']['input']]
+        # - files named by reader options (e.g. --metadata-file)
+        for opt in options['pandoc']['options']['r'].values():
+            if type(opt) is str and os.path.isfile(opt):
+                sources.append([opt, cache.file_digest(opt)])
+    except OSError:
+        # - not a local file (e.g. a url)
+        return None
+    return cache.make_key('ast',
+                          util.pandoc_fingerprint(options),
+                          options['pandoc']['read'],
+                          opts,
+                          sources)
+
+# - most recently used styledefs of this process, keyed as in the
+# - persistent cache
+STYLEDEFS = cache.Memo(const.MEMO_STYLEDEFS)
+
 def load_all_styledefs(options):
     """
         return global, local styledef pair
@@ -54,12 +106,12 @@ def load_all_styledefs(options):
         finds local styledef from `./styles/*.{yaml,yml}`
     """
     support_dir = options['panzer']['panzer_support']
-    info.log('DEBUG', 'panzer', 'loading global style definitions file')
-    global_styledef = load_styledef(support_dir, options)
+    info.log('DEBUG', 'panzer', 'loading global and local style definitions files')
+    global_styledef, local_styledef = \
+        util.run_concurrently([(load_styledef, [support_dir, options]),
+                               (load_styledef, ['.', options])])
     if global_styledef == {}:
         info.log('WARNING', 'panzer', 'no global style definitions found')
-    info.log('DEBUG', 'panzer', 'loading local style definitions file')
-    local_styledef = load_styledef('.', options)
     return global_styledef, local_styledef
 
 def load_styledef(path, options):
@@ -71,50 +123,67 @@ def load_styledef(path, options):
     """
     # - read in style definition data from yaml files
     styles_dir = os.path.join(path, 'styles')
-    filenames = list()
-    # - read from .panzer/styles/*.{yaml,yml}
-    if os.path.exists(styles_dir):
-        filenames = [os.path.join(path, 'styles', f)
-                     for f in os.listdir(styles_dir)
-                     if f.endswith('.yaml')
-                     or f.endswith('.yml')]
-    # - read .panzer/styles.yaml -- legacy option
-    elif os.path.exists(os.path.join(path, 'styles.yaml')):
-        filenames = [os.path.join(path, 'styles.yaml')]
+    filenames = styledef_files(path)
+    if filenames == []:
+        return dict()
+    # - build pandoc reader options
+    opts =  meta.build_cli_options(options['pandoc']['options']['r'])
+    # - remove inappropriate options for styles.yaml
+    BAD_OPTS = ['metadata', 'track-changes', 'extract-media']
+    opts = [x for x in opts if x not in BAD_OPTS]
+    # - use cached result if style files and pandoc are unchanged
+    key = cache.make_key('styledef',
+                         util.pandoc_fingerprint(options),
+                         opts,
+                         [cache.file_fingerprint(f) for f in filenames])
+    loaded = STYLEDEFS.get(key)
+    if loaded is not None and not options['panzer']['rebuild_cache']:
+        info.log('DEBUG', 'panzer', 'style definitions in "%s" already loaded'
+                 % styles_dir)
+        return copy.deepcopy(loaded)
+    cached = cache.read(options, 'styledef', key)
+    if cached is not None:
+        info.log('DEBUG', 'panzer', 'style definitions in "%s" loaded from cache'
+                 % styles_dir)
+        STYLEDEFS.put(key, cached)
+        return copy.deepcopy(cached)
     data = list()
     for f in filenames:
         with open(f, 'r', encoding=const.ENCODING) as styles_file:
             data += styles_file.readlines()
             data += ['\n']
-    if data == []:
-        return dict()
     # - top and tail with metadata markings
     data.insert(0, "---\n")
     data.append("...\n")
     data_string = ''.join(data)
+    styledef, success = read_metadata(data_string, opts, options)
+    if success:
+        cache.write(options, 'styledef', key, styledef)
+        STYLEDEFS.put(key, copy.deepcopy(styledef))
+    return styledef
+
+def read_metadata(data_string, opts, options, reader='markdown'):
+    """
+        return metadata branch as dict of pandoc's read of `data_string`
+        with `reader` and reader options `opts`, and whether pandoc succeeded
+    """
     # - build pandoc command
     command = [options['panzer']['pandoc']]
     command += ['-']
+    command += ['--read', reader]
     command += ['--write', 'json']
     command += ['--output', '-']
-    opts =  meta.build_cli_options(options['pandoc']['options']['r'])
-    # - remove inappropriate options for styles.yaml
-    BAD_OPTS = ['metadata', 'track-changes', 'extract-media']
-    opts = [x for x in opts if x not in BAD_OPTS]
     command += opts
     info.log('DEBUG', 'panzer', 'run "%s"' % ' '.join(command))
     # - send to pandoc to convert to json
     in_pipe = data_string
-    out_pipe = ''
+    out_pipe_bytes = bytes()
     stderr = ''
+    returncode = None
     try:
-        process = subprocess.Popen(command,
-                                   stderr=subprocess.PIPE,
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
         in_pipe_bytes = in_pipe.encode(const.ENCODING)
-        out_pipe_bytes, stderr_bytes = process.communicate(input=in_pipe_bytes)
-        out_pipe = out_pipe_bytes.decode(const.ENCODING)
+        out_pipe_bytes, stderr_bytes, returncode, _ = \
+            util.run_process(command, in_pipe_bytes)
         stderr = stderr_bytes.decode(const.ENCODING)
     except OSError as err:
         info.log('ERROR', 'pandoc', err)
@@ -123,13 +192,149 @@ def load_styledef(path, options):
     # - convert json to python dict
     ast = None
     try:
-        ast = json.loads(out_pipe)
+        ast = codec.loads(out_pipe_bytes)
     except ValueError:
         raise error.BadASTError('failed to receive valid '
                                 'json object from pandoc')
     # - return metadata branch of dict
     if not ast:
-        return dict()
+        metadata = dict()
     else:
-        return meta.get_metadata(ast)
+        metadata = meta.get_metadata(ast)
+    return metadata, returncode == 0
+
+def can_prescan(options):
+    """
+        return True if yaml metadata blocks of input documents can be
+        scanned before the full read: reader is markdown and all inputs
+        are local files
+    """
+    for name in options['pandoc']['input']:
+        if not os.path.isfile(name):
+            return False
+    return uses_reader(options, const.PRESCAN_READERS, const.PRESCAN_EXTENSIONS)
+
+def uses_reader(options, readers, extensions):
+    """
+        return True if input documents are read by one of `readers`: the
+        reader given, or else the one implied by the extensions of all input
+        files, must be listed in `readers` or `extensions`
+    """
+    reader = options['pandoc']['read']
+    if reader:
+        return re.split('[+-]', reader)[0] in readers
+    for name in options['pandoc']['input']:
+        if os.path.splitext(name)[1].lower() not in extensions:
+            return False
+    return True
+
+def mentions_commandline(options):
+    """
+        return True if yaml metadata blocks of input documents or style
+        definition files mention `commandline`: otherwise no reader options
+        can be set, and there is nothing for `prescan` to find
+    """
+    try:
+        for name in options['pandoc']['input']:
+            with open(name, 'r', encoding=const.ENCODING) as input_file:
+                blocks = metadata_blocks(input_file.read())
+            if any('commandline' in block for block in blocks):
+                return True
+        for name in styledef_files(options['panzer']['panzer_support']) \
+                    + styledef_files('.'):
+            with open(name, 'r', encoding=const.ENCODING) as styles_file:
+                if 'commandline' in styles_file.read():
+                    return True
+    except (OSError, ValueError):
+        # - let `prescan` report the problem
+        return True
+    return False
+
+def prescan(options):
+    """
+        return metadata of input documents read from their yaml metadata
+        blocks only (used to work out reader options before the full read)
+        returns None if the metadata blocks cannot be extracted
+    """
+    blocks = list()
+    try:
+        for name in options['pandoc']['input']:
+            with open(name, 'r', encoding=const.ENCODING) as input_file:
+                blocks += metadata_blocks(input_file.read())
+    except (OSError, ValueError) as err:
+        info.log('DEBUG', 'panzer', 'cannot scan metadata: %s' % err)
+        return None
+    if not blocks:
+        return dict()
+    data_string = '\n'.join(blocks)
+    opts = meta.build_cli_options(options['pandoc']['options']['r'])
+    # - do not write media files when only scanning metadata
+    opts = [x for x in opts if not x.startswith('--extract-media')]
+    reader = options['pandoc']['read'] or 'markdown'
+    key = cache.make_key('prescan',
+                         util.pandoc_fingerprint(options),
+                         reader,
+                         opts,
+                         data_string)
+    cached = cache.read(options, 'prescan', key)
+    if cached is not None:
+        return cached
+    info.log('DEBUG', 'panzer', 'scanning metadata of source document(s)')
+    metadata, success = read_metadata(data_string, opts, options, reader)
+    if not success:
+        return None
+    cache.write(options, 'prescan', key, metadata)
+    return metadata
+
+def metadata_blocks(text):
+    """
+        return list of yaml metadata blocks in markdown `text`, following
+        pandoc's rules: a block opens with a `---` line that starts the
+        text or follows a blank line, and is not itself followed by a
+        blank line; it closes with a `---` or `...` line
+    """
+    lines = text.splitlines()
+    blocks = list()
+    fence = None
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        # - skip fenced code blocks
+        if fence:
+            if line.strip().startswith(fence):
+                fence = None
+            i += 1
+            continue
+        match = re.match(r'\s{0,3}(`{3,}|~{3,})', line)
+        if match:
+            fence = match.group(1)
+            i += 1
+            continue
+        if line.rstrip() == '---' \
+           and (i == 0 or not lines[i - 1].strip()) \
+           and i + 1 < len(lines) and lines[i + 1].strip():
+            for j in range(i + 1, len(lines)):
+                if lines[j].rstrip() in ['---', '...']:
+                    blocks.append('\n'.join(['---'] + lines[i + 1:j] + ['...', '']))
+                    i = j
+                    break
+        i += 1
+    return blocks
 
+def styledef_files(path):
+    """
+        return list of styledef files at `path`:
+        `path/styles/*.{yaml,yml}`, or else `path/styles.yaml`
+    """
+    styles_dir = os.path.join(path, 'styles')
+    filenames = list()
+    # - read from .panzer/styles/*.{yaml,yml}
+    if os.path.exists(styles_dir):
+        filenames = [os.path.join(path, 'styles', f)
+                     for f in os.listdir(styles_dir)
+                     if f.endswith('.yaml')
+                     or f.endswith('.yml')]
+    # - read .panzer/styles.yaml -- legacy option
+    elif os.path.exists(os.path.join(path, 'styles.yaml')):
+        filenames = [os.path.join(path, 'styles.yaml')]
+    return filenames
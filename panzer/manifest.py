@@ -0,0 +1,155 @@
+""" build manifests: skip a build if nothing it depends on has changed
+
+A manifest records a fingerprint of everything a successful build used:
+the command line options, the pandoc executable, the source documents,
+the style definition files, the template, the run list executables,
+files named by pandoc options, and the output file itself. If all of
+these are unchanged, the build is skipped without running anything.
+"""
+import json
+import os
+import shutil
+from . import cache
+from . import const
+from . import info
+from . import load
+from . import util
+
+def enabled(options):
+    """ return True if manifest should be used for this build """
+    return bool(options['panzer']['manifest']) \
+        and options['pandoc']['output'] != '-' \
+        and not options['panzer']['stdin_temp_file']
+
+def manifest_path(options):
+    """
+    return path of manifest: next to the output file, or inside the cache
+    directory if `---cache-dir` is set
+    """
+    output = options['pandoc']['output']
+    if options['panzer']['cache_dir']:
+        key = cache.make_key('manifest', os.path.abspath(output))
+        return os.path.join(options['panzer']['cache_dir'], 'manifest',
+                            key + '.json')
+    head, tail = os.path.split(output)
+    return os.path.join(head, '.' + tail + '.panzer-manifest.json')
+
+def up_to_date(options):
+    """ return True if manifest shows that build can be skipped """
+    if not enabled(options):
+        return False
+    path = manifest_path(options)
+    try:
+        with open(path, 'r', encoding=const.ENCODING) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as err:
+        info.log('DEBUG', 'panzer', 'ignoring bad manifest "%s": %s'
+                 % (path, err))
+        return False
+    if manifest.get('version') != const.MANIFEST_VERSION:
+        return False
+    if manifest['settings'] != settings_fingerprint(options):
+        info.log('DEBUG', 'panzer', 'manifest: options changed')
+        return False
+    if manifest['styledef_files'] != styledef_files(options):
+        info.log('DEBUG', 'panzer', 'manifest: style definition files changed')
+        return False
+    if manifest['output'] != cache.file_fingerprint(options['pandoc']['output']):
+        info.log('DEBUG', 'panzer', 'manifest: output changed')
+        return False
+    for dependency, fingerprint in manifest['files']:
+        if dependency_fingerprint(dependency) != fingerprint:
+            info.log('DEBUG', 'panzer', 'manifest: "%s" changed' % dependency)
+            return False
+    return True
+
+def write(doc, settings):
+    """
+    write manifest of successful build of `doc`
+    `settings`: fingerprint of the options before the build started
+    """
+    if not enabled(doc.options):
+        return
+    path = manifest_path(doc.options)
+    # - do not vouch for a build in which something failed
+    if doc.write_failed \
+    or [entry for entry in doc.runlist if entry['status'] == const.FAILED]:
+        remove(path)
+        return
+    dependencies = list(doc.options['pandoc']['input'])
+    dependencies += styledef_files(doc.options)
+    if doc.options['pandoc']['template']:
+        dependencies.append(doc.options['pandoc']['template'])
+    elif doc.template:
+        dependencies.append(doc.template)
+    dependencies += [entry['command'] for entry in doc.runlist]
+    dependencies += option_files(doc.options)
+    # - remove duplicates, keep order
+    dependencies = list(dict.fromkeys(dependencies))
+    manifest = {
+        'version':        const.MANIFEST_VERSION,
+        'settings':       settings,
+        'styledef_files': styledef_files(doc.options),
+        'files':          [[dependency, dependency_fingerprint(dependency)]
+                           for dependency in dependencies],
+        'output':         cache.file_fingerprint(doc.options['pandoc']['output'])
+    }
+    try:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding=const.ENCODING) as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+    except OSError as err:
+        info.log('WARNING', 'panzer', 'cannot write manifest "%s": %s'
+                 % (path, err))
+        return
+    info.log('DEBUG', 'panzer', 'manifest written to "%s"' % path)
+
+def remove(path):
+    """ remove manifest at `path` if it exists """
+    if os.path.exists(path):
+        os.remove(path)
+
+def settings_fingerprint(options):
+    """ return json-able fingerprint of options that affect the build """
+    pandoc = dict(options['pandoc'])
+    del pandoc['mutable']
+    settings = {'pandoc':         pandoc,
+                'panzer_support': options['panzer']['panzer_support'],
+                'executable':     util.pandoc_fingerprint(options),
+                'cwd':            os.getcwd()}
+    # - normalise (e.g. tuples to lists) to compare with json from file
+    return json.loads(json.dumps(settings))
+
+def styledef_files(options):
+    """ return list of global and local style definition files """
+    return sorted(load.styledef_files(options['panzer']['panzer_support'])) \
+        + sorted(load.styledef_files('.'))
+
+def option_files(options):
+    """ return list of existing files named by pandoc options """
+    files = list()
+    for phase in ['r', 'w']:
+        for val in options['pandoc']['options'][phase].values():
+            if type(val) is str:
+                files.append(val)
+            elif type(val) is list:
+                files += [item[0] for item in val if type(item[0]) is str]
+    return [f for f in files if os.path.isfile(f)]
+
+def dependency_fingerprint(path):
+    """
+    return fingerprint of dependency at `path`: digest of its contents if a
+    file, stat data of executable if a command found on PATH, else None
+    """
+    try:
+        if os.path.isfile(path):
+            return ['file', cache.file_digest(path)]
+    except OSError:
+        return None
+    executable = shutil.which(path)
+    if executable:
+        return ['command', cache.file_fingerprint(os.path.realpath(executable))]
+    return None
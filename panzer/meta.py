@@ -1,6 +1,7 @@
 """ Functions for manipulating metadata """
 import pandocfilters
 import shlex
+from . import cache
 from . import const
 from . import info
 from . import util
@@ -93,6 +94,26 @@ def apply_kill_rules(old_list):
             continue
     return new_list
 
+def trim_runlists(metadata, fields):
+    """
+    apply kill rules to run lists of `metadata` under `fields`, removing
+    fields whose items are all killed
+    """
+    for field in fields:
+        try:
+            original_list = get_content(metadata, field, 'MetaList')
+            trimmed_list = apply_kill_rules(original_list)
+            if trimmed_list:
+                set_content(metadata, field, trimmed_list, 'MetaList')
+            else:
+                # if all items killed, delete field
+                del metadata[field]
+        except error.MissingField:
+            continue
+        except error.WrongType as err:
+            info.log('WARNING', 'panzer', err)
+            continue
+
 def get_nested_content(metadata, fields, expected_type_of_leaf=None):
     """ return content of field by traversing a list of MetaMaps
 
@@ -227,6 +248,40 @@ def get_runlist(metadata, kind, options):
                          'Syntax should be args: "`--ARGUMENTS`"'
                          % command_str)
                 entry['arguments'] = list()
+        # - filters can be run inside panzer's process (python filters)
+        # - or as persistent workers
+        for field in ['inprocess', 'persistent']:
+            if field not in item_content:
+                continue
+            try:
+                if kind != 'filter':
+                    raise error.WrongType('"%s" is only allowed for filters' % field)
+                if get_content(item_content, field, 'MetaBool'):
+                    entry[field] = True
+            except error.WrongType as err:
+                info.log('ERROR', 'panzer', '"%s": %s---running it as '
+                         'external process' % (command_str, err))
+        # - scripts can run concurrently
+        # -   `parallel: true`: alongside neighbouring parallel scripts
+        # -   `after: NAMES`: as soon as the scripts with `name: NAME` finish
+        for field in ['parallel', 'name', 'after']:
+            if field not in item_content:
+                continue
+            try:
+                if kind not in ['preflight', 'postflight', 'cleanup']:
+                    raise error.WrongType('"%s" is only allowed for preflight, '
+                                          'postflight and cleanup scripts' % field)
+                if field == 'parallel':
+                    if get_content(item_content, field, 'MetaBool'):
+                        entry[field] = True
+                elif field == 'name':
+                    entry[field] = pandocfilters.stringify(
+                        get_content(item_content, field))
+                else:
+                    entry[field] = get_list_or_inline(item_content, field)
+            except error.WrongType as err:
+                info.log('ERROR', 'panzer', '"%s": %s---ignoring it'
+                         % (command_str, err))
         runlist.append(entry)
     return runlist
 
@@ -240,23 +295,122 @@ def check_c_and_t_exist(item):
         raise error.BadASTError(message)
 
 def expand_style_hierarchy(stylelist, styledef):
-    """ return stylelist expanded to include all parent styles """
-    expanded_list = []
+    """
+    return stylelist expanded to include all parent styles: each style comes
+    after its parents, and appears once, at its first position in a
+    depth-first walk of the parents in the order listed (see `linearize`)
+    """
+    graph = compile_style_graph(styledef)
+    expanded_list = list()
+    seen = set()
     for style in stylelist:
         if style not in styledef:
+            missing = [style]
+            linear = list()
+        else:
+            try:
+                linear = linearize(graph, style)
+            except error.StyleCycleError as err:
+                info.log('ERROR', 'panzer', '%s---ignoring style "%s"' % (err, style))
+                continue
+            missing = [name for name in linear if name not in styledef]
+        for name in missing:
+            if name in seen:
+                continue
+            seen.add(name)
             # - style not in styledef tree
             info.log('ERROR', 'panzer',
                      'No style definition found for style "%s" --- ignoring it'
-                     % style)
-            continue
-        defcontent = get_content(styledef, style, 'MetaMap')
-        if 'parent' in defcontent:
-            # - non-leaf node
-            parents = get_list_or_inline(defcontent, 'parent')
-            expanded_list.extend(expand_style_hierarchy(parents, styledef))
-        expanded_list.append(style)
+                     % name)
+        for name in linear:
+            if name not in seen:
+                seen.add(name)
+                expanded_list.append(name)
     return expanded_list
 
+# - compiled style graphs of this process, keyed by parents of each style
+STYLE_GRAPHS = cache.Memo(const.MEMO_STYLE_GRAPHS)
+
+def compile_style_graph(styledef):
+    """
+    return style graph of `styledef`: dict with
+        'parents': each style's tuple of parents (or the error raised in
+                   reading its definition)
+        'linear':  memo of linearizations made by `linearize`
+    the most recently used graphs are kept, and reused for later documents
+    whose style definitions have the same parents
+    """
+    parents = dict()
+    for style in styledef:
+        try:
+            defcontent = get_content(styledef, style, 'MetaMap')
+            if 'parent' in defcontent:
+                parents[style] = tuple(get_list_or_inline(defcontent, 'parent'))
+            else:
+                parents[style] = tuple()
+        except (error.WrongType, error.BadASTError) as err:
+            parents[style] = err
+    key = tuple(sorted((style, value if type(value) is tuple else repr(value))
+                       for style, value in parents.items()))
+    graph = STYLE_GRAPHS.get(key)
+    if graph is None:
+        graph = {'parents': parents, 'linear': dict()}
+        STYLE_GRAPHS.put(key, graph)
+    return graph
+
+def linearize(graph, style):
+    """
+    return list of `style` and its ancestors in style `graph`, parents
+    before children: the ancestors of each parent, in the order the parents
+    are listed, then the style itself, keeping only the first appearance of
+    a style reached by more than one path (names not defined in the graph
+    are included, to be reported by the caller)
+    raises StyleCycleError if a style is its own ancestor
+    """
+    parents = graph['parents']
+    linear = graph['linear']
+    if style in linear:
+        return linear[style]
+    # - walk without recursion, so that deep hierarchies do not hit
+    # - python's recursion limit
+    path = [style]
+    stack = [iter(parents_of(parents, style))]
+    while stack:
+        for parent in stack[-1]:
+            if parent in linear:
+                continue
+            if parent in path:
+                cycle = path[path.index(parent):] + [parent]
+                raise error.StyleCycleError('cyclic "parent" references: %s'
+                                            % ' -> '.join(cycle))
+            path.append(parent)
+            stack.append(iter(parents_of(parents, parent)))
+            break
+        else:
+            # - all parents of style on top of stack are linearized
+            name = path.pop()
+            stack.pop()
+            result = list()
+            seen = set()
+            for parent in parents_of(parents, name):
+                for ancestor in linear[parent]:
+                    if ancestor not in seen:
+                        seen.add(ancestor)
+                        result.append(ancestor)
+            result.append(name)
+            linear[name] = result
+    return linear[style]
+
+def parents_of(parents, style):
+    """
+    return parents of `style` in `parents` of style graph (none if style
+    is not defined); raises error met in reading style's definition
+    """
+    value = parents.get(style, tuple())
+    if type(value) is not tuple:
+        raise value
+    return value
+
 def build_cli_options(dic):
     """
     return a sorted list of command line options specified in the options
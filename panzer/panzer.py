@@ -8,18 +8,27 @@ Copyright : Copyright 2015, Mark Sprevak
 License   : BSD3
 """
 
+import copy
+import io
 import json
-import os
 import subprocess
 import sys
+import time
+from . import cache
 from . import cli
+from . import codec
 from . import document
 from . import error
 from . import info
 from . import load
+from . import manifest
 from . import meta
+from . import server
+from . import trace
+from . import usage
 from . import util
 from . import version
+from . import watch
 
 __version__ = version.VERSION
 
@@ -28,51 +37,35 @@ __version__ = version.VERSION
 def main():
     """ the main function """
     info.time_stamp('panzer started')
+    # - daemon and client modes
+    panzer_known = cli.panzer_parse()[0]
+    if panzer_known['connect']:
+        sys.exit(server.submit(sys.argv[1:]))
+    if panzer_known['serve']:
+        sys.exit(server.serve(panzer_known))
+    if panzer_known['watch']:
+        sys.exit(watch.watch(sys.argv[1:]))
     doc = document.Document()
+    if panzer_known['clear_cache']:
+        for field in panzer_known:
+            if panzer_known[field]:
+                doc.options['panzer'][field] = panzer_known[field]
+        info.start_logger(doc.options)
+        sys.exit(cache.clear(doc.options))
+    started = time.perf_counter()
     try:
         doc.options = cli.parse_cli_options(doc.options)
-        util.check_pandoc_exists(doc.options)
-        old_reader_opts = dict(doc.options['pandoc']['options']['r'])
+        trace.start(doc.options, started)
+        usage.reset()
+        trace.record('parse command line', 'stage', started, time.perf_counter())
         info.time_stamp('cli options parsed')
-        info.start_logger(doc.options)
+        with trace.span('start logger', 'stage'):
+            info.start_logger(doc.options)
         info.time_stamp('logger started')
-        util.check_support_directory(doc.options)
+        with trace.span('check support directory', 'stage'):
+            util.check_support_directory(doc.options)
         info.time_stamp('support directory checked')
-        global_styledef, local_styledef = load.load_all_styledefs(doc.options)
-        info.time_stamp('local + global styledefs loaded')
-        ast = load.load(doc.options)
-        info.time_stamp('document loaded')
-        doc.populate(ast, global_styledef, local_styledef)
-        doc.transform()
-        doc.lock_commandline()
-        new_reader_opts = doc.options['pandoc']['options']['r']
-        # check if `commandline` contains any new reader options
-        if new_reader_opts != old_reader_opts:
-            # re-read input documents with new reader settings
-            opts =  meta.build_cli_options(new_reader_opts)
-            info.log('INFO', 'panzer', info.pretty_title('pandoc read with metadata options'))
-            info.log('INFO', 'panzer', 'pandoc reading with options:')
-            info.log('INFO', 'panzer', info.pretty_list(opts, separator=' '))
-            info.go_quiet()
-            doc.empty()
-            global_styledef, local_styledef = load.load_all_styledefs(doc.options)
-            ast = load.load(doc.options)
-            doc.populate(ast, global_styledef, local_styledef)
-            doc.transform()
-            info.go_loud(doc.options)
-        doc.build_runlist()
-        doc.purge_style_fields()
-        info.time_stamp('document transformed')
-        doc.run_scripts('preflight')
-        info.time_stamp('preflight scripts done')
-        doc.jsonfilter()
-        info.time_stamp('json filters done')
-        doc.pandoc()
-        info.time_stamp('pandoc done')
-        doc.postprocess()
-        info.time_stamp('postprocess done')
-        doc.run_scripts('postflight')
-        info.time_stamp('postflight scripts done')
+        run(doc)
     except error.SetupError as err:
         # - errors that occur before logging starts
         print(err, file=sys.stderr)
@@ -94,24 +87,199 @@ def main():
         info.log('CRITICAL', 'panzer', err)
         sys.exit(1)
     finally:
-        doc.run_scripts('cleanup', do_not_stop=True)
-        # - if temp file created in setup, remove it
-        if doc.options['panzer']['stdin_temp_file']:
-            os.remove(doc.options['panzer']['stdin_temp_file'])
-            info.log('DEBUG', 'panzer', 'deleted temp file: %s'
-                     % doc.options['panzer']['stdin_temp_file'])
-        # - write json message to file if ---debug set
-        if doc.options['panzer']['debug']:
-            filename = doc.options['panzer']['debug'] + '.json'
-            content = info.pretty_json_repr(json.loads(doc.json_message()))
-            with open(filename, 'w', encoding='utf8') as output_file:
-                output_file.write(content)
-                output_file.flush()
-        info.log('DEBUG', 'panzer', info.pretty_end_log('panzer quits'))
+        finish(doc)
 
     # - successful exit
     info.time_stamp('finished')
     sys.exit(0)
 
+def run(doc):
+    """ run panzer's pipeline on `doc`, whose options are already set """
+    # - skip build if manifest of last build shows nothing has changed
+    with trace.span('manifest check', 'stage'):
+        up_to_date = manifest.up_to_date(doc.options)
+    if up_to_date:
+        info.log('INFO', 'panzer', 'output "%s" up to date---nothing to do'
+                 % doc.options['pandoc']['output'])
+        return
+    settings = manifest.settings_fingerprint(doc.options)
+    codec.select(doc.options)
+    # - check pandoc, load styledefs and either scan the metadata or read
+    # - the document, concurrently; scan only if `commandline` could set
+    # - reader options, so the read stays concurrent otherwise
+    prescan = load.can_prescan(doc.options) \
+              and load.mentions_commandline(doc.options)
+    with trace.span('setup', 'stage'):
+        _, (global_styledef, local_styledef), result = \
+            util.run_concurrently([(util.check_pandoc_exists, [doc.options]),
+                                   (load.load_all_styledefs, [doc.options]),
+                                   (load.prescan if prescan else load.load,
+                                    [doc.options])])
+    if prescan and result is not None:
+        # - read document once, with reader options set by `commandline`
+        read_options = copy.deepcopy(doc.options)
+        read_options['pandoc']['options']['r'] = \
+            prescan_reader_options(doc.options, result,
+                                   global_styledef, local_styledef)
+        with trace.span('load', 'stage'):
+            ast = load.load(read_options)
+    else:
+        read_options = doc.options
+        with trace.span('load', 'stage'):
+            ast = load.load(doc.options) if prescan else result
+    old_reader_opts = copy.deepcopy(read_options['pandoc']['options']['r'])
+    info.time_stamp('pandoc checked + styledefs + document loaded')
+    with trace.span('transform', 'stage'):
+        doc.populate(ast, copy.deepcopy(global_styledef), copy.deepcopy(local_styledef))
+        doc.transform()
+        doc.lock_commandline()
+    new_reader_opts = doc.options['pandoc']['options']['r']
+    # check if `commandline` contains any reader options not used in read
+    if new_reader_opts != old_reader_opts:
+        # re-read input documents with new reader settings
+        opts =  meta.build_cli_options(new_reader_opts)
+        info.log('INFO', 'panzer', info.pretty_title('pandoc read with metadata options'))
+        info.log('INFO', 'panzer', 'pandoc reading with options:')
+        info.log('INFO', 'panzer', info.pretty_list(opts, separator=' '))
+        info.go_quiet()
+        with trace.span('reload', 'stage'):
+            doc.empty()
+            ast = load.load(doc.options)
+            doc.populate(ast, global_styledef, local_styledef)
+            doc.transform()
+        info.go_loud(doc.options)
+    with trace.span('runlist', 'stage'):
+        doc.build_runlist()
+        doc.purge_style_fields()
+    info.time_stamp('document transformed')
+    with trace.span('preflight', 'stage'):
+        doc.run_scripts('preflight')
+    info.time_stamp('preflight scripts done')
+    with trace.span('filter', 'stage'):
+        doc.jsonfilter()
+    info.time_stamp('json filters done')
+    with trace.span('pandoc write', 'stage'):
+        doc.pandoc()
+    info.time_stamp('pandoc done')
+    with trace.span('postprocess', 'stage'):
+        doc.postprocess()
+    info.time_stamp('postprocess done')
+    with trace.span('postflight', 'stage'):
+        doc.run_scripts('postflight')
+    info.time_stamp('postflight scripts done')
+    with trace.span('manifest', 'stage'):
+        manifest.write(doc, settings)
+
+def prescan_reader_options(options, metadata, global_styledef, local_styledef):
+    """
+    return reader options that `commandline` fields would set for a
+    document with `metadata`, given the style definitions
+    (its log messages are discarded: the real transform logs them again)
+    """
+    scan = document.Document()
+    scan.options = copy.deepcopy(options)
+    scan.set_metadata(metadata)
+    info.start_capture()
+    try:
+        scan.populate(scan.ast, copy.deepcopy(global_styledef),
+                      copy.deepcopy(local_styledef))
+        scan.transform()
+    finally:
+        info.stop_capture()
+    return scan.options['pandoc']['options']['r']
+
+def finish(doc):
+    """ run cleanup scripts and tidy up after `doc` has been processed """
+    with trace.span('cleanup', 'stage'):
+        doc.run_scripts('cleanup', do_not_stop=True)
+    # - if stdin was copied into a file in setup, release it
+    util.release_stdin_file(doc.options)
+    usage.log_summary()
+    # - write json message to file if ---debug set
+    if doc.options['panzer']['debug']:
+        filename = doc.options['panzer']['debug'] + '.json'
+        content = info.pretty_json_repr(json.loads(doc.json_message()))
+        with open(filename, 'w', encoding='utf8') as output_file:
+            output_file.write(content)
+            output_file.flush()
+    trace.write(doc.options)
+    info.log('DEBUG', 'panzer', info.pretty_end_log('panzer quits'))
+
+# Library interface
+
+def render(inputs, options=(), support_dir=None, stdin=None):
+    """
+    run panzer in-process and return the result, without writing to
+    stdout, reading `sys.argv`, configuring logging, or exiting
+
+    args:
+        inputs      : list of input files ('-' for `stdin`)
+        options     : list of other panzer or pandoc command line options,
+                      as they would be given to panzer on the command line
+                      (e.g. ['--to', 'latex', '---strict'])
+        support_dir : panzer support directory (default: `~/.panzer`)
+        stdin       : bytes read as input file '-'
+
+    returns dictionary:
+        'status'  : 0 if successful, 1 if a fatal error occurred
+        'output'  : bytes that panzer would have written to stdout
+                    (empty if output is written to a file)
+        'runlist' : run list, including status of each item
+        'template': path to template used (None if no template)
+        'log'     : list of (level, sender, message) log messages
+
+    Relative paths (input files, local styles, executables) are resolved
+    against the current working directory.
+    """
+    doc = document.Document()
+    doc.stdout = io.BytesIO()
+    status = 0
+    args = list(options) + list(inputs)
+    if support_dir:
+        args += ['---panzer-support', support_dir]
+    info.start_capture()
+    try:
+        try:
+            started = time.perf_counter()
+            doc.options = cli.parse_cli_options(doc.options, args, stdin)
+            trace.start(doc.options, started)
+            usage.reset()
+            trace.record('parse command line', 'stage', started, time.perf_counter())
+            info.BUFFER.strict = doc.options['panzer']['strict']
+            info.BUFFER.quiet = doc.options['panzer']['quiet']
+            util.check_support_directory(doc.options, interactive=False)
+            run(doc)
+        except error.SetupError as err:
+            status = 1
+            info.log('CRITICAL', 'panzer', err)
+        except error.StrictModeError:
+            status = 1
+            info.log('CRITICAL', 'panzer',
+                     'cannot continue because error occurred while in "strict" mode')
+        except subprocess.CalledProcessError:
+            status = 1
+            info.log('CRITICAL', 'panzer',
+                     'cannot continue because of fatal error')
+        except (KeyError,
+                error.MissingField,
+                error.BadASTError,
+                error.WrongType,
+                error.InternalError) as err:
+            status = 1
+            info.log('CRITICAL', 'panzer', err)
+        except SystemExit as err:
+            # - argparse exits on bad arguments, `--help` and `--version`
+            status = 1 if err.code else 0
+        finally:
+            info.BUFFER.strict = False
+            finish(doc)
+    finally:
+        records = info.stop_capture()
+    return {'status':  status,
+            'output':  doc.stdout.getvalue(),
+            'runlist': doc.runlist,
+            'template': doc.template,
+            'log':     records}
+
 if __name__ == '__main__':
     main()
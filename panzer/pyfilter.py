@@ -0,0 +1,143 @@
+""" run python json filters built on pandocfilters inside panzer's process
+
+A filter entry with `inprocess: true` is loaded once (per process) by
+running its script with pandocfilters' `toJSONFilter` and `toJSONFilters`
+replaced by functions that record the filter's actions. The actions are
+then applied directly to the document panzer holds, with no new process
+and no json encoding and decoding.
+
+While a filter's code runs, `sys.argv`, `sys.stdin`, `sys.stderr` and
+`PANZER_SHARED` are replaced for the whole process. So filter code runs
+under a lock, one filter at a time, even when several threads call
+`panzer.render`. Other threads still see the replaced streams, so their
+writes to `sys.stderr` made while a filter runs are logged as that
+filter's messages.
+"""
+import io
+import os
+import runpy
+import sys
+import threading
+import pandocfilters
+from . import cache
+from . import const
+from . import info
+
+# - actions of filters most recently loaded by this process, keyed by
+# - fingerprint of file
+ACTIONS = cache.Memo(const.MEMO_FILTER_ACTIONS)
+# - held while filter code runs (see `FilterContext`)
+LOCK = threading.RLock()
+
+class Captured(Exception):
+    """ raised to stop a filter script once its actions are recorded """
+    def __init__(self, actions):
+        super().__init__()
+        self.actions = actions
+
+def load_actions(entry, options):
+    """
+    return list of pandocfilters actions of filter `entry`, or None if
+    it cannot be run in process
+    """
+    path = entry['command']
+    fingerprint = cache.file_fingerprint(path)
+    if fingerprint is None:
+        return None
+    key = repr(fingerprint)
+    actions = ACTIONS.get(key)
+    if actions is not None:
+        return actions
+    # - only run scripts that can hand over their actions
+    try:
+        with open(path, 'r', encoding='utf8') as script:
+            uses_pandocfilters = 'toJSONFilter' in script.read()
+    except (OSError, ValueError):
+        uses_pandocfilters = False
+    if not uses_pandocfilters:
+        info.log('WARNING', 'panzer', '"%s" does not call pandocfilters\' '
+                 'toJSONFilter---running it as external filter' % path)
+        return None
+    def record_one(action):
+        """ replacement for `toJSONFilter` """
+        raise Captured([action])
+    def record_many(actions):
+        """ replacement for `toJSONFilters` """
+        raise Captured(list(actions))
+    actions = None
+    with LOCK:
+        saved = (pandocfilters.toJSONFilter, pandocfilters.toJSONFilters)
+        pandocfilters.toJSONFilter = record_one
+        pandocfilters.toJSONFilters = record_many
+        try:
+            # - script must not read panzer's own stdin
+            with FilterContext([path] + entry['arguments'], options,
+                               stdin=io.StringIO()):
+                runpy.run_path(path, run_name='__main__')
+        except Captured as captured:
+            actions = captured.actions
+        except (Exception, SystemExit) as err:     # pylint: disable=W0703
+            info.log('ERROR', 'panzer', 'cannot load "%s" in process: %s'
+                     % (path, repr(err)))
+            return None
+        finally:
+            pandocfilters.toJSONFilter, pandocfilters.toJSONFilters = saved
+    if actions is None:
+        info.log('WARNING', 'panzer', '"%s" does not call pandocfilters\' '
+                 'toJSONFilter---running it as external filter' % path)
+        return None
+    ACTIONS.put(key, actions)
+    return actions
+
+def apply(ast, actions, entry, options, stderr):
+    """
+    return document `ast` transformed by `actions` of filter `entry`
+    `stderr`: stream that receives what the filter writes to stderr
+    """
+    if 'meta' in ast:
+        metadata = ast['meta']
+    elif isinstance(ast, list) and ast[0]:
+        # - old api
+        metadata = ast[0]['unMeta']
+    else:
+        metadata = dict()
+    writer = entry['arguments'][0] if entry['arguments'] else ''
+    with FilterContext([entry['command']] + entry['arguments'], options,
+                       stderr=stderr):
+        for action in actions:
+            ast = pandocfilters.walk(ast, action, writer, metadata)
+    return ast
+
+class FilterContext(object):
+    """
+    context in which filter code runs: its command line in `sys.argv`,
+    `PANZER_SHARED` set as for external filters, and stdin and stderr
+    replaced; `LOCK` is held, so only one thread at a time is in it
+    """
+    def __init__(self, argv, options, stdin=None, stderr=None):
+        self.argv = argv
+        self.shared = os.path.join(options['panzer']['panzer_support'], 'shared')
+        self.stdin = stdin
+        self.stderr = stderr
+        self.saved = None
+
+    def __enter__(self):
+        LOCK.acquire()
+        self.saved = (sys.argv, sys.stdin, sys.stderr,
+                      os.environ.get('PANZER_SHARED'))
+        sys.argv = list(self.argv)
+        if self.stdin is not None:
+            sys.stdin = self.stdin
+        if self.stderr is not None:
+            sys.stderr = self.stderr
+        os.environ['PANZER_SHARED'] = self.shared
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.argv, sys.stdin, sys.stderr, shared = self.saved
+        if shared is None:
+            del os.environ['PANZER_SHARED']
+        else:
+            os.environ['PANZER_SHARED'] = shared
+        LOCK.release()
+        return False
@@ -0,0 +1,193 @@
+""" panzer daemon: render jobs sent over a unix socket by a thin client
+
+The daemon keeps its worker processes warm between jobs: they have
+already imported panzer, built its argument parsers, probed pandoc and
+loaded the global style definitions. Style definitions are reloaded
+whenever their files change.
+
+A job is sent as two length-prefixed frames:
+    1. json request: {'args': [...], 'cwd': ..., 'env': {...}, 'stdin': bool}
+    2. bytes read from stdin (empty if 'stdin' is false)
+The reply is two length-prefixed frames:
+    1. json result: {'status': ..., 'log': [...], 'runlist': [...]}
+    2. bytes written to stdout
+"""
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+from . import cli
+from . import const
+from . import document
+from . import error
+from . import info
+from . import load
+from . import util
+
+def serve(panzer_known):
+    """
+    run daemon on socket given by `---serve`, until interrupted
+    `panzer_known`: panzer's command line options
+    returns exit status
+    """
+    options = document.Document().options
+    for field in panzer_known:
+        if panzer_known[field]:
+            options['panzer'][field] = panzer_known[field]
+    socket_path = options['panzer']['serve']
+    workers = options['panzer']['workers'] or os.cpu_count() or 1
+    info.start_logger(options)
+    # - daemon has no terminal to ask on: create default support directory
+    util.check_support_directory(options, interactive=False)
+    if not os.path.exists(options['panzer']['panzer_support']):
+        try:
+            util.create_default_support_dir()
+        except OSError as err:
+            info.log('CRITICAL', 'panzer', 'cannot create support directory '
+                     '"%s": %s' % (options['panzer']['panzer_support'], err))
+            return 1
+    # - warm up state that forked workers inherit
+    try:
+        util.check_pandoc_exists(options)
+    except error.SetupError as err:
+        info.log('CRITICAL', 'panzer', err)
+        return 1
+    load.load_styledef(options['panzer']['panzer_support'], options)
+    context = multiprocessing.get_context('fork')
+    pool = context.Pool(workers)
+    handler = make_handler(pool)
+    remove_stale_socket(socket_path)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, handler)
+    except OSError as err:
+        info.log('CRITICAL', 'panzer', 'cannot listen on "%s": %s'
+                 % (socket_path, err))
+        pool.terminate()
+        return 1
+    server.daemon_threads = True
+    # - shut down cleanly on SIGTERM as well as SIGINT
+    signal.signal(signal.SIGTERM, stop_serving)
+    info.log('INFO', 'panzer', info.pretty_title('serving'))
+    info.log('INFO', 'panzer', 'listening on "%s" with %d worker(s)'
+             % (socket_path, workers))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        info.log('INFO', 'panzer', 'shutting down')
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
+
+def stop_serving(signum, frame):
+    """ signal handler that stops the daemon """
+    # pylint: disable=W0613
+    raise SystemExit(0)
+
+def remove_stale_socket(socket_path):
+    """ remove socket file left at `socket_path` by a daemon that is gone """
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+    finally:
+        probe.close()
+
+def make_handler(pool):
+    """ return request handler class that sends its jobs to `pool` """
+    class Handler(socketserver.StreamRequestHandler):
+        """ handle one job sent by a client """
+        def handle(self):
+            try:
+                request = json.loads(util.read_frame(self.rfile).decode(const.ENCODING))
+                stdin = util.read_frame(self.rfile)
+            except (AttributeError, EOFError, ValueError):
+                # - malformed or abandoned request
+                return
+            result = pool.apply(run_job, (request, stdin))
+            reply = {'status':  result['status'],
+                     'log':     result['log'],
+                     'runlist': result['runlist']}
+            try:
+                util.write_frame(self.wfile,
+                                 json.dumps(reply).encode(const.ENCODING))
+                util.write_frame(self.wfile, result['output'])
+            except OSError:
+                # - client went away
+                pass
+    return Handler
+
+def run_job(request, stdin):
+    """ run job in a worker process and return result of `render` """
+    # pylint: disable=C0415
+    # import here: `panzer.panzer` imports this module
+    from .panzer import render
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    if not request['stdin']:
+        stdin = None
+    return render([], request['args'], stdin=stdin)
+
+def submit(args):
+    """
+    send job for command line arguments `args` to panzer daemon named by
+    `---connect`, print its log, write its output, and return exit status
+    """
+    panzer_known, unknown = cli.panzer_parse(args)
+    socket_path = panzer_known['connect']
+    # - forward all arguments but `---connect SOCKET`
+    job_args = list()
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == '---connect':
+            skip = True
+        elif not arg.startswith('---connect='):
+            job_args.append(arg)
+    inputs = cli.pandoc_parse(unknown)[0]['input'] or ['-']
+    use_stdin = '-' in inputs
+    stdin = sys.stdin.buffer.read() if use_stdin else bytes()
+    request = {'args':  job_args,
+               'cwd':   os.getcwd(),
+               'env':   dict(os.environ),
+               'stdin': use_stdin}
+    options = document.Document().options
+    options['panzer']['quiet'] = panzer_known['quiet']
+    info.start_logger(options)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        stream = connection.makefile('rwb')
+        util.write_frame(stream, json.dumps(request).encode(const.ENCODING))
+        util.write_frame(stream, stdin)
+        reply_bytes = util.read_frame(stream)
+        output = util.read_frame(stream)
+        if reply_bytes is None or output is None:
+            raise EOFError('daemon closed connection')
+        reply = json.loads(reply_bytes.decode(const.ENCODING))
+    except (OSError, EOFError, ValueError) as err:
+        info.log('CRITICAL', 'panzer', 'cannot get reply from panzer daemon on "%s": %s'
+                 % (socket_path, err))
+        return 1
+    finally:
+        connection.close()
+    info.replay(reply['log'])
+    sys.stdout.buffer.write(output)
+    sys.stdout.flush()
+    return reply['status']
@@ -0,0 +1,6 @@
+-- remove json message that panzer passes to filters (in `panzer_reserved`)
+-- from metadata, before pandoc writes the document (used by ---pipeline)
+function Meta(meta)
+  meta.panzer_reserved = nil
+  return meta
+end
@@ -0,0 +1,112 @@
+""" ---profile: record where panzer spends its time
+
+Spans (a name, a category, a start and a duration, and a dict of details
+such as payload sizes) are recorded for each stage of panzer's pipeline,
+each run list entry, and each phase of each subprocess (spawn, writing
+its stdin, and waiting for it). The trace is written in Chrome's trace
+event format, which can be opened in chrome://tracing or Perfetto.
+
+Each run of panzer (e.g. each call of `panzer.render`) records its own
+trace, which belongs to the thread that started it. Threads that work
+for the same run are handed the trace with `attach` (see
+`util.thread_state`), so concurrent runs in one process keep apart.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from . import const
+from . import info
+
+# - per-thread trace being recorded: whether enabled, its start time, its
+# - events and the names of the threads they were recorded in
+LOCAL = threading.local()
+LOCK = threading.Lock()
+
+# - trace of threads that are recording none
+DISABLED = {'enabled': False, 'start': 0.0, 'events': list(), 'threads': dict()}
+
+def start(options, started=None):
+    """
+    start recording a trace for the current thread, if ---profile is set
+    `started`: time (from `time.perf_counter`) that trace starts at
+    """
+    LOCAL.trace = {'enabled': bool(options['panzer']['profile']),
+                   'start': time.perf_counter() if started is None else started,
+                   'events': list(),
+                   'threads': dict()}
+
+def current():
+    """ return trace being recorded by current thread """
+    return getattr(LOCAL, 'trace', DISABLED)
+
+def attach(trace):
+    """ record spans of current thread into `trace` (from `current`) """
+    LOCAL.trace = trace
+
+def enabled():
+    """ return True if a trace is being recorded """
+    return current()['enabled']
+
+@contextlib.contextmanager
+def span(name, category, **details):
+    """
+    record span `name` of `category` around the body of the `with`
+    statement; yields dict of details, to which the body can add
+    """
+    if not current()['enabled']:
+        yield details
+        return
+    begin = time.perf_counter()
+    try:
+        yield details
+    finally:
+        record(name, category, begin, time.perf_counter(), details)
+
+def record(name, category, begin, end, details=None):
+    """
+    record span `name` of `category` from time `begin` to `end` (from
+    `time.perf_counter`) in the current thread
+    """
+    trace = current()
+    if not trace['enabled']:
+        return
+    thread = threading.current_thread()
+    event = {'name': name,
+             'cat': category,
+             'ph': 'X',
+             'ts': round((begin - trace['start']) * 1e6, 3),
+             'dur': round((end - begin) * 1e6, 3),
+             'pid': os.getpid(),
+             'tid': thread.ident,
+             'args': dict(details or dict())}
+    with LOCK:
+        trace['events'].append(event)
+        trace['threads'][thread.ident] = thread.name
+
+def write(options):
+    """ write trace recorded by current thread to file named by ---profile """
+    trace = current()
+    if not trace['enabled']:
+        return
+    trace['enabled'] = False
+    with LOCK:
+        threads = dict(trace['threads'])
+        recorded = list(trace['events'])
+    events = [{'name': 'thread_name',
+               'ph': 'M',
+               'pid': os.getpid(),
+               'tid': ident,
+               'args': {'name': name}}
+              for ident, name in threads.items()]
+    events += sorted(recorded, key=lambda event: event['ts'])
+    data = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    try:
+        with open(options['panzer']['profile'], 'w',
+                  encoding=const.ENCODING) as trace_file:
+            json.dump(data, trace_file)
+        info.log('DEBUG', 'panzer', 'trace written to "%s"'
+                 % options['panzer']['profile'])
+    except OSError as err:
+        info.log('ERROR', 'panzer', 'cannot write trace: %s' % err)
@@ -0,0 +1,125 @@
+""" resource usage of the processes that panzer runs
+
+Each process started by `util.run_process` or `util.run_pipeline` is
+reaped with `os.wait4`, which reports the CPU time it used and its peak
+resident set size. Together with its wall time and the bytes panzer wrote
+to its stdin and read from its stdout and stderr, these are recorded for
+the current run, stored on the process's run list entry, passed on in the
+json message, and summarised in the log when panzer finishes.
+
+As with the trace (see `trace`), the records belong to the thread that
+started the run, and are handed to threads working for the same run with
+`attach`, so concurrent calls of `panzer.render` keep apart.
+
+Figures that panzer cannot see are None: CPU time and peak memory where
+`os.wait4` is not available, and the bytes passing directly between
+processes in a pipeline or from the last process to an output file.
+On Linux, the peak memory of a process started from panzer's process can
+include the memory of panzer at the time it was forked.
+"""
+import os
+import sys
+import threading
+import time
+from . import info
+
+# - per-thread list of usage of each process run for current document, in
+# - order of exit
+LOCAL = threading.local()
+LOCK = threading.Lock()
+
+def reset():
+    """ start recording processes for a new document in current thread """
+    LOCAL.processes = list()
+
+def current():
+    """ return list of records of current thread (None if not recording) """
+    return getattr(LOCAL, 'processes', None)
+
+def attach(processes):
+    """ record processes of current thread into `processes` (from `current`) """
+    LOCAL.processes = processes
+
+def wait(process, started):
+    """
+    wait for `process`, started at time `started` (from
+    `time.perf_counter`), to exit and return its return code and usage:
+        'wall'     : seconds from start to exit
+        'user'     : seconds of CPU time in user mode
+        'system'   : seconds of CPU time in kernel mode
+        'max_rss'  : peak resident set size, in KiB
+    (callers add the bytes of its stdin, stdout and stderr)
+    """
+    usage = {'wall': None, 'user': None, 'system': None, 'max_rss': None}
+    if hasattr(os, 'wait4') and process.returncode is None:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # - already reaped elsewhere
+            pass
+        else:
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+            usage['user'] = rusage.ru_utime
+            usage['system'] = rusage.ru_stime
+            # - macOS reports bytes, Linux KiB
+            if sys.platform == 'darwin':
+                usage['max_rss'] = rusage.ru_maxrss // 1024
+            else:
+                usage['max_rss'] = rusage.ru_maxrss
+    returncode = process.wait()
+    usage['wall'] = time.perf_counter() - started
+    return returncode, usage
+
+def record(command, usage):
+    """ record `usage` of process that ran `command` """
+    recorded = current()
+    if recorded is None:
+        return
+    with LOCK:
+        recorded.append({'command': command, 'usage': usage})
+
+def processes():
+    """ return list of processes recorded for current document """
+    recorded = current()
+    if recorded is None:
+        return list()
+    with LOCK:
+        return list(recorded)
+
+def log_summary():
+    """ log usage of each process recorded for current document """
+    recorded = processes()
+    if not recorded:
+        return
+    info.log('INFO', 'panzer', info.pretty_title('resource usage'))
+    for process in recorded:
+        info.log('INFO', 'panzer', pretty_usage(process['usage']))
+        info.log('INFO', 'panzer', '    %s' % process['command'])
+
+def pretty_usage(usage):
+    """ return pretty printed usage of a process """
+    def seconds(value):
+        """ format time """
+        return '-' if value is None else '%.3fs' % value
+    def size(value):
+        """ format amount of data or memory in bytes """
+        if value is None:
+            return '-'
+        if value < 1024:
+            return '%dB' % value
+        for unit in 'KMG':
+            value /= 1024
+            if value < 1024 or unit == 'G':
+                return '%.1f%s' % (value, unit)
+    max_rss = None if usage['max_rss'] is None else usage['max_rss'] * 1024
+    return '  wall %s  user %s  sys %s  rss %s  in %s  out %s  err %s' \
+        % (seconds(usage['wall']),
+           seconds(usage['user']),
+           seconds(usage['system']),
+           size(max_rss),
+           size(usage.get('stdin_bytes')),
+           size(usage.get('stdout_bytes')),
+           size(usage.get('stderr_bytes')))
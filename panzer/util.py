@@ -1,40 +1,346 @@
 """ Support functions for non-core operations """
+import concurrent.futures
+import errno
 import os
+import shutil
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from . import cache
 from . import const
 from . import error
 from . import info
+from . import trace
+from . import usage
+
+# - pandoc probes done by this process, keyed by executable's fingerprint
+PANDOC_PROBES = dict()
+
+# - umask of this process, which sets the permissions of new output files
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 def check_pandoc_exists(options):
-    """ check pandoc exists """
+    """
+    check pandoc exists, record its version, and return its probe
+    (probe is cached, and only redone if the pandoc executable changes)
+    """
+    fingerprint = pandoc_fingerprint(options)
+    if fingerprint is None:
+        raise error.SetupError('%s not found as pandoc executable' %
+                               options['panzer']['pandoc'])
+    key = cache.make_key('pandoc', fingerprint)
+    probe = PANDOC_PROBES.get(key)
+    if probe is None:
+        probe = cache.read(options, 'pandoc', key)
+    if probe is None:
+        probe = probe_pandoc(options)
+        cache.write(options, 'pandoc', key, probe)
+    PANDOC_PROBES[key] = probe
+    pandoc_ver = probe['version']
+    options['panzer']['pandoc_version'] = pandoc_ver
+    # print('pandoc version: %s' % pandoc_ver, file=sys.stderr)
+    if versiontuple(pandoc_ver) < versiontuple(const.REQUIRE_PANDOC_ATLEAST):
+        raise error.SetupError('pandoc %s or greater required'
+                               '---found pandoc version %s'
+                               % (const.REQUIRE_PANDOC_ATLEAST, pandoc_ver))
+    # use the new >=1.18 pandoc API or old (<1.18) one
+    if probe['old_api']:
+        const.USE_OLD_API = True
+    return probe
+
+def probe_pandoc(options):
+    """
+    return dictionary describing pandoc executable:
+        `version`:         version string
+        `old_api`:         True if pandoc uses old (<1.18) API
+    """
     try:
-        stdout_bytes = subprocess.check_output([options['panzer']['pandoc'],
-                                                "--version"])
-        stdout = stdout_bytes.decode(const.ENCODING)
+        process = subprocess.run([options['panzer']['pandoc'], '--version'],
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
     except PermissionError as err:
         raise error.SetupError('%s cannot be executed as pandoc executable' %
                                 options['panzer']['pandoc'])
     except OSError as err:
-        if err.errno == os.errno.ENOENT:
+        if err.errno == errno.ENOENT:
             raise error.SetupError('%s not found as pandoc executable' %
                                    options['panzer']['pandoc'])
         else:
             raise error.SetupError(err)
-    stdout_list = stdout.splitlines()
-    pandoc_ver = stdout_list[0].split(' ')[1]
-    # print('pandoc version: %s' % pandoc_ver, file=sys.stderr)
-    if versiontuple(pandoc_ver) < versiontuple(const.REQUIRE_PANDOC_ATLEAST):
-        raise error.SetupError('pandoc %s or greater required'
-                               '---found pandoc version %s'
-                               % (const.REQUIRE_PANDOC_ATLEAST, pandoc_ver))
+    stdout_bytes = process.stdout if process.returncode == 0 else bytes()
+    try:
+        pandoc_ver = stdout_bytes.decode(const.ENCODING).splitlines()[0].split(' ')[1]
+        versiontuple(pandoc_ver)
+    except (IndexError, ValueError):
+        raise error.SetupError('cannot read version of pandoc executable %s'
+                               % options['panzer']['pandoc'])
     # check whether to use the new >=1.18 pandoc API or old (<1.18) one
     NEW_PANDOC_API = "1.18"
-    if versiontuple(pandoc_ver) < versiontuple(NEW_PANDOC_API):
-        const.USE_OLD_API = True
-        # print('using old (<1.18) pandoc API')
-    # else:
-        # print('using new (>=1.18) pandoc API')
+    return {'version': pandoc_ver,
+            'old_api': versiontuple(pandoc_ver) < versiontuple(NEW_PANDOC_API)}
+
+def pandoc_fingerprint(options):
+    """ return fingerprint of pandoc executable (None if not found) """
+    path = shutil.which(options['panzer']['pandoc']) \
+        or options['panzer']['pandoc']
+    return cache.file_fingerprint(os.path.realpath(path))
+
+def run_concurrently(calls):
+    """
+    run each `(function, args)` pair in `calls` in its own thread and return
+    list of their return values; log messages of each call are replayed, and
+    any exception re-raised, in the order in which calls are listed
+    """
+    results = list()
+    state = thread_state()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        futures = [pool.submit(capture_call, function, args, state)
+                   for function, args in calls]
+        for future in futures:
+            result, err, records = future.result()
+            info.replay(records)
+            if err:
+                raise err
+            results.append(result)
+    return results
+
+def capture_call(function, args, state=None):
+    """
+    call `function(*args)` with log messages captured, and return its
+    result (or None), the exception it raised (or None) and its log messages
+    `state`: state of the run the call belongs to (see `thread_state`)
+    """
+    if state is not None:
+        adopt_thread_state(state)
+    info.start_capture()
+    try:
+        with trace.span(function.__name__, 'stage'):
+            return function(*args), None, info.stop_capture()
+    except Exception as err:        # pylint: disable=W0703
+        return None, err, info.stop_capture()
+
+def thread_state():
+    """
+    return state that the current thread keeps for the run of panzer it
+    is doing (the trace being recorded, and the usage of the processes
+    run), to be handed to other threads doing work for the same run with
+    `adopt_thread_state`
+    """
+    return {'trace': trace.current(), 'usage': usage.current()}
+
+def adopt_thread_state(state):
+    """ make current thread work for run whose `state` is given """
+    trace.attach(state['trace'])
+    usage.attach(state['usage'])
+
+def run_process(command, in_bytes, stdout=subprocess.PIPE, env=None, pass_fds=()):
+    """
+    run `command` (run by the shell if a string), write `in_bytes` to its
+    stdin (if None, stdin is empty), and wait for it to exit
+    `stdout`: as for `subprocess.Popen`
+    returns its stdout (None unless `stdout` is PIPE), stderr, return code
+    and resource usage (see `usage.wait`), which is also recorded
+    spawning the process, writing to its stdin, and waiting for it to
+    finish are traced separately (see ---profile)
+    """
+    name = command if type(command) is str else ' '.join(command)
+    started = time.perf_counter()
+    with trace.span('spawn', 'process', command=name) as details:
+        process = subprocess.Popen(command,
+                                   shell=type(command) is str,
+                                   stdin=subprocess.DEVNULL if in_bytes is None
+                                   else subprocess.PIPE,
+                                   stdout=stdout,
+                                   stderr=subprocess.PIPE,
+                                   env=env,
+                                   pass_fds=pass_fds)
+        details['pid'] = process.pid
+    outputs = [None, None]
+    def drain(index, stream):
+        """ collect output of `stream` """
+        outputs[index] = stream.read()
+        stream.close()
+    threads = [threading.Thread(target=drain, args=(1, process.stderr))]
+    if process.stdout is not None:
+        threads.append(threading.Thread(target=drain, args=(0, process.stdout)))
+    for thread in threads:
+        thread.start()
+    if in_bytes is not None:
+        with trace.span('write stdin', 'process', bytes=len(in_bytes)):
+            try:
+                process.stdin.write(in_bytes)
+            except BrokenPipeError:
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+    with trace.span('wait', 'process', pid=process.pid) as details:
+        for thread in threads:
+            thread.join()
+        returncode, process_usage = usage.wait(process, started)
+        process_usage['stdin_bytes'] = len(in_bytes or bytes())
+        process_usage['stdout_bytes'] = None if outputs[0] is None else len(outputs[0])
+        process_usage['stderr_bytes'] = len(outputs[1])
+        details['returncode'] = returncode
+        details.update(process_usage)
+    usage.record(name, process_usage)
+    return outputs[0], outputs[1], returncode, process_usage
+
+def run_pipeline(commands, in_bytes, env=None, stdout=None, pass_fds=()):
+    """
+    run `commands` concurrently, each one's stdout connected to the next
+    one's stdin, and feed `in_bytes` to the first (a command given as a
+    string is run by the shell)
+    `stdout`: binary stream to which output of last command is written as
+              it is produced: directly by the command, if `stdout` is a
+              file, or else copied in chunks; if None, output is discarded
+    `pass_fds`: file descriptors that commands inherit
+    returns lists of stderr, return code and resource usage (see
+    `usage.wait`) of each command; usage is also recorded
+    """
+    processes = list()
+    names = list()
+    started = list()
+    direct = stdout is None or fileno(stdout) is not None
+    try:
+        for index, command in enumerate(commands):
+            stdin = processes[-1].stdout if processes else subprocess.PIPE
+            last_stdout = subprocess.PIPE
+            if direct and index == len(commands) - 1:
+                last_stdout = stdout if stdout is not None else subprocess.DEVNULL
+            names.append(command if type(command) is str else ' '.join(command))
+            started.append(time.perf_counter())
+            with trace.span('spawn', 'process', command=names[-1]) as details:
+                processes.append(subprocess.Popen(command,
+                                                  shell=type(command) is str,
+                                                  stdin=stdin,
+                                                  stdout=last_stdout,
+                                                  stderr=subprocess.PIPE,
+                                                  env=env,
+                                                  pass_fds=pass_fds))
+                details['pid'] = processes[-1].pid
+            # - only the next command reads from the previous one
+            if stdin is not subprocess.PIPE:
+                stdin.close()
+    except OSError:
+        for process in processes:
+            process.kill()
+            process.wait()
+        raise
+    stderrs = [bytes()] * len(processes)
+    state = thread_state()
+    def feed():
+        """ write `in_bytes` to first command """
+        adopt_thread_state(state)
+        with trace.span('write stdin', 'process', bytes=len(in_bytes)):
+            try:
+                processes[0].stdin.write(in_bytes)
+            except BrokenPipeError:
+                pass
+            finally:
+                try:
+                    processes[0].stdin.close()
+                except BrokenPipeError:
+                    pass
+    def drain(index):
+        """ collect stderr of a command """
+        stderrs[index] = processes[index].stderr.read()
+    threads = [threading.Thread(target=feed)]
+    threads += [threading.Thread(target=drain, args=(index,))
+                for index in range(len(processes))]
+    for thread in threads:
+        thread.start()
+    size = None
+    if not direct:
+        with trace.span('copy stdout', 'process') as details:
+            size = 0
+            for chunk in iter(lambda: processes[-1].stdout.read(const.PIPE_CHUNK_SIZE), b''):
+                stdout.write(chunk)
+                size += len(chunk)
+            details['bytes'] = size
+    returncodes = list()
+    usages = list()
+    for index, process in enumerate(processes):
+        with trace.span('wait', 'process', pid=process.pid) as details:
+            returncode, process_usage = usage.wait(process, started[index])
+            returncodes.append(returncode)
+            usages.append(process_usage)
+            details['returncode'] = returncode
+    for thread in threads:
+        thread.join()
+    if not direct:
+        processes[-1].stdout.close()
+    for process in processes:
+        process.stderr.close()
+    # - bytes passed between commands, or written by last command
+    # - straight to its destination, are not seen by panzer
+    for index, process_usage in enumerate(usages):
+        process_usage['stdin_bytes'] = len(in_bytes) if index == 0 else None
+        process_usage['stdout_bytes'] = size if index == len(usages) - 1 else None
+        process_usage['stderr_bytes'] = len(stderrs[index])
+        usage.record(names[index], process_usage)
+    return stderrs, returncodes, usages
+
+def stdin_file(stdin=None):
+    """
+    copy panzer's stdin (or bytes `stdin`) into an anonymous in-memory file
+    (memfd) and return a path by which panzer, and child processes given
+    `stdin_fds`, can read it; if memfds are not available, a temp file in
+    the system's temp directory is used instead
+    """
+    if hasattr(os, 'memfd_create') and os.path.isdir(const.MEMFD_DIR):
+        handle = os.memfd_create('panzer-stdin')
+        path = os.path.join(const.MEMFD_DIR, str(handle))
+    else:
+        handle, path = tempfile.mkstemp(prefix='__panzer-', suffix='__')
+    # - memfd stays open: it disappears once closed
+    with open(handle, 'wb', closefd=not is_memfd(path)) as stdin_file_:
+        if stdin is None:
+            shutil.copyfileobj(sys.stdin.buffer, stdin_file_)
+        else:
+            stdin_file_.write(stdin)
+    return path
+
+def is_memfd(path):
+    """ return True if `path` was made by `stdin_file` for a memfd """
+    return os.path.dirname(path) == const.MEMFD_DIR
+
+def stdin_fds(options):
+    """
+    return tuple of file descriptors that child processes reading the input
+    files need to inherit (the memfd holding stdin, if any)
+    """
+    path = options['panzer']['stdin_temp_file']
+    if path and is_memfd(path):
+        return (int(os.path.basename(path)),)
+    return tuple()
+
+def release_stdin_file(options):
+    """ close or remove file made by `stdin_file`, if any """
+    path = options['panzer']['stdin_temp_file']
+    if not path:
+        return
+    if is_memfd(path):
+        os.close(int(os.path.basename(path)))
+    else:
+        os.remove(path)
+    options['panzer']['stdin_temp_file'] = str()
+    info.log('DEBUG', 'panzer', 'released stdin file: %s' % path)
+
+def fileno(stream):
+    """ return file descriptor of `stream`, or None if it has none """
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
 
 def versiontuple(version_string):
     """ return tuple of version_string """
@@ -42,8 +348,11 @@ def versiontuple(version_string):
     # disable warning for using builtin 'map'
     return tuple(map(int, (version_string.split("."))))
 
-def check_support_directory(options):
-    """ check support directory exists """
+def check_support_directory(options, interactive=True):
+    """
+    check support directory exists
+    `interactive`:  offer to create default support directory if missing
+    """
     if options['panzer']['panzer_support'] != const.DEFAULT_SUPPORT_DIR:
         if not os.path.exists(options['panzer']['panzer_support']):
             info.log('ERROR', 'panzer',
@@ -53,7 +362,8 @@ def check_support_directory(options):
                      'using default panzer support directory: %s'
                      % const.DEFAULT_SUPPORT_DIR)
             options['panzer']['panzer_support'] = const.DEFAULT_SUPPORT_DIR
-    if options['panzer']['panzer_support'] == const.DEFAULT_SUPPORT_DIR:
+    if options['panzer']['panzer_support'] == const.DEFAULT_SUPPORT_DIR \
+            and interactive:
         if not os.path.exists(const.DEFAULT_SUPPORT_DIR):
             info.log('WARNING', 'panzer',
                      'default panzer support directory "%s" not found'
@@ -63,8 +373,49 @@ def check_support_directory(options):
                      % const.DEFAULT_SUPPORT_DIR)
             input("    Press Enter to continue...")
             create_default_support_dir()
-    os.environ['PANZER_SHARED'] = \
+
+def child_env(options):
+    """ return environment for external processes run by panzer """
+    env = dict(os.environ)
+    env['PANZER_SHARED'] = \
         os.path.join(options['panzer']['panzer_support'], 'shared')
+    return env
+
+def write_temp_file(content, prefix, suffix):
+    """
+    write bytes `content` to a new temporary file and return its path
+    (the caller removes the file)
+    """
+    with tempfile.NamedTemporaryFile(prefix='__panzer-' + prefix,
+                                     suffix=suffix,
+                                     delete=False) as temp_file:
+        temp_file.write(content)
+    return temp_file.name
+
+def output_temp_file(path):
+    """
+    return path of a new empty file, next to output file `path` and with
+    the same extension, to write the output to before it replaces `path`
+    (see `replace_output`)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix='.__panzer-',
+                                         suffix=os.path.splitext(path)[1],
+                                         dir=directory)
+    os.close(handle)
+    return temp_path
+
+def replace_output(temp_path, path):
+    """
+    move finished output file `temp_path` over `path`, with the
+    permissions of the file it replaces (or of a new file)
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0o666 & ~UMASK
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, path)
 
 def create_default_support_dir():
     """ create a empty panzer support directory """
@@ -108,3 +459,24 @@ def resolve_path(filename, kind, options):
             return path
     return filename
 
+def write_frame(stream, data):
+    """ write bytes `data` to binary `stream` as a length-prefixed frame """
+    stream.write(struct.pack('>Q', len(data)))
+    stream.write(data)
+    stream.flush()
+
+def read_frame(stream):
+    """
+    return bytes of next length-prefixed frame read from binary `stream`
+    (None if stream closed before a frame started)
+    """
+    header = stream.read(8)
+    if not header:
+        return None
+    if len(header) != 8:
+        raise EOFError('stream closed inside frame header')
+    size = struct.unpack('>Q', header)[0]
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError('stream closed inside frame')
+    return data
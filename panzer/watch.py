@@ -0,0 +1,302 @@
+""" watch mode: re-run panzer whenever the files a build depends on change
+
+Builds run in a forked child process, so that a build superseded by a
+newer change can be cancelled (with every process it started). The
+parent keeps the pandoc probe and the style definitions in memory and
+refreshes them before each build, so each child inherits them warm.
+"""
+import ctypes
+import ctypes.util
+import errno
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from . import cli
+from . import const
+from . import document
+from . import error
+from . import info
+from . import load
+from . import util
+
+def watch(args):
+    """
+    build document with command line arguments `args`, then rebuild it
+    whenever one of its inputs changes, until interrupted
+    returns exit status
+    """
+    # - parse options
+    args = [arg for arg in args if arg != '---watch']
+    options = document.Document().options
+    panzer_known, unknown = cli.panzer_parse(args)
+    for field in panzer_known:
+        if panzer_known[field]:
+            options['panzer'][field] = panzer_known[field]
+    pandoc_known = cli.pandoc_parse(unknown)[0]
+    inputs = pandoc_known['input'] or ['-']
+    info.start_logger(options)
+    if '-' in inputs:
+        info.log('CRITICAL', 'panzer', 'cannot watch stdin---give input files')
+        return 1
+    util.check_support_directory(options)
+    # - files and directories every build depends on
+    base_paths = set(inputs)
+    base_paths.add(os.path.join('.', 'styles'))
+    base_paths.add(os.path.join(options['panzer']['panzer_support'], 'styles'))
+    if pandoc_known['template']:
+        base_paths.add(pandoc_known['template'])
+    watcher = make_watcher(base_paths)
+    info.log('INFO', 'panzer', info.pretty_title('watching'))
+    info.log('INFO', 'panzer', 'watching %d path(s) with %s'
+             % (len(base_paths), watcher.method))
+    build = None
+    changed = set()
+    try:
+        while True:
+            # - start a build if none running or current one superseded
+            if changed or build is None:
+                if build is not None and build.running:
+                    info.log('INFO', 'panzer', 'cancelling superseded build')
+                    build.cancel()
+                if changed:
+                    info.log('INFO', 'panzer', info.pretty_title('rebuilding'))
+                    info.log('INFO', 'panzer', 'changed:')
+                    info.log('INFO', 'panzer', info.pretty_list(sorted(changed)))
+                build = Build(args, options)
+                changed = set()
+            # - collect result of a finished build
+            if build.running and build.finished():
+                result = build.result()
+                info.replay(result['log'])
+                if result['output']:
+                    sys.stdout.buffer.write(result['output'])
+                    sys.stdout.flush()
+                info.log('INFO', 'panzer', info.pretty_title('build %s'
+                         % ('done' if result['status'] == 0 else 'failed')))
+                watcher.set_paths(base_paths | build_paths(result))
+            # - wait for changes, then wait for burst of changes to settle
+            changed = watcher.wait(const.WATCH_TICK)
+            if changed:
+                while True:
+                    more = watcher.wait(const.WATCH_DEBOUNCE)
+                    if not more:
+                        break
+                    changed |= more
+    except KeyboardInterrupt:
+        info.log('INFO', 'panzer', 'stopped watching')
+    finally:
+        if build is not None and build.running:
+            build.cancel()
+        watcher.close()
+    return 0
+
+def build_paths(result):
+    """ return set of paths of template and executables used by build """
+    paths = set()
+    if result['template']:
+        paths.add(result['template'])
+    for entry in result['runlist']:
+        paths.add(entry['command'])
+    return {path for path in paths if os.path.exists(path)}
+
+class Build(object):
+    """ a build running in a child process """
+    def __init__(self, args, options):
+        """ start build with command line arguments `args` """
+        # - refresh state that the child inherits
+        info.start_capture()
+        try:
+            util.check_pandoc_exists(options)
+            load.load_all_styledefs(options)
+        except error.PanzerError:
+            # - reported by the build itself
+            pass
+        finally:
+            info.stop_capture()
+        context = multiprocessing.get_context('fork')
+        self.receiver, sender = context.Pipe(duplex=False)
+        self.process = context.Process(target=run_build,
+                                       args=(args, sender),
+                                       daemon=True)
+        self.process.start()
+        sender.close()
+        self.running = True
+
+    def finished(self):
+        """ return True if build has a result ready or has died """
+        return self.receiver.poll() or not self.process.is_alive()
+
+    def result(self):
+        """ return result of build (as returned by `render`) """
+        self.running = False
+        try:
+            result = self.receiver.recv()
+        except EOFError:
+            result = {'status':   1,
+                      'output':   bytes(),
+                      'runlist':  list(),
+                      'template': None,
+                      'log':      [('ERROR', 'panzer', 'build died unexpectedly')]}
+        self.process.join()
+        self.receiver.close()
+        return result
+
+    def cancel(self):
+        """ stop build and every process it started """
+        self.running = False
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except OSError:
+            # - child has not set up its process group yet
+            self.process.terminate()
+        self.process.join()
+        self.receiver.close()
+
+def run_build(args, sender):
+    """ run build in child process and send result to parent """
+    # pylint: disable=C0415
+    # import here: `panzer.panzer` imports this module
+    from .panzer import render
+    # - own process group, so that cancelling kills children too
+    os.setpgrp()
+    sender.send(render([], args))
+    sender.close()
+
+def make_watcher(paths):
+    """ return inotify watcher if available, else polling watcher """
+    try:
+        return InotifyWatcher(paths)
+    except OSError:
+        return PollWatcher(paths)
+
+class PollWatcher(object):
+    """ watch paths by polling their stat data """
+    method = 'polling'
+
+    def __init__(self, paths):
+        self.paths = set()
+        self.state = dict()
+        self.set_paths(paths)
+
+    def set_paths(self, paths):
+        """ watch `paths` (files or directories) """
+        self.paths = set(paths)
+        # - keep old state of paths already watched, so that changes made
+        # - since the last check are not missed
+        self.state = {path: self.state[path] if path in self.state
+                      else snapshot(path)
+                      for path in self.paths}
+
+    def wait(self, timeout):
+        """ return set of paths changed before `timeout` seconds pass """
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path in self.paths:
+                current = snapshot(path)
+                if current != self.state[path]:
+                    self.state[path] = current
+                    changed.add(path)
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(const.WATCH_POLL_INTERVAL, remaining))
+
+    def close(self):
+        """ stop watching """
+        self.paths = set()
+
+def snapshot(path):
+    """ return stat data of file, or of directory and its entries """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    state = [(stat.st_mtime_ns, stat.st_size, stat.st_ino)]
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            state.append((name, snapshot(os.path.join(path, name))))
+    return state
+
+# inotify event flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+    """
+    watch paths with linux's inotify
+    (directories containing watched files are watched, so that files
+    replaced by editors saving via rename are still noticed)
+    """
+    method = 'inotify'
+
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = set()
+        self.watches = dict()
+        self.set_paths(paths)
+
+    def set_paths(self, paths):
+        """ watch `paths` (files or directories) """
+        self.paths = {os.path.abspath(path) for path in paths}
+        dirs = set()
+        for path in self.paths:
+            dirs.add(path if os.path.isdir(path) else os.path.dirname(path))
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM \
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for directory in dirs - set(self.watches.values()):
+            descriptor = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), mask)
+            if descriptor >= 0:
+                self.watches[descriptor] = directory
+
+    def wait(self, timeout):
+        """ return set of paths changed before `timeout` seconds pass """
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, _, _, length = \
+                IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self.watches.get(descriptor)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if path in self.paths:
+                changed.add(path)
+            elif directory in self.paths:
+                changed.add(directory)
+        return changed
+
+    def close(self):
+        """ stop watching """
+        os.close(self.fd)
@@ -0,0 +1,314 @@
+""" persistent filter workers: filters that stay alive between documents
+
+A filter item with `persistent: true` is started once (with the
+environment variable `PANZER_FILTER_WORKER` set to 1, and no arguments)
+and then kept running, to filter every document that the panzer process
+handles (e.g. in the daemon, or through `render`). Workers are pooled: a
+job checks out an idle worker, and a new one is started if every worker
+of the filter is busy with another document. A worker is restarted
+if it crashes, and after `const.FILTER_WORKER_MAX_JOBS` jobs. A worker
+that does not reply to a job within `const.FILTER_WORKER_JOB_TIMEOUT`
+seconds is killed, and its filter run as an external filter instead.
+
+When it is ready, the worker writes a length-prefixed frame (see
+`util.write_frame`) holding the json object {'protocol': 1} to its
+stdout. Each job is then sent to the worker's stdin as two frames:
+    1. json request: {'arguments': [...]}
+    2. document as json
+The worker replies on its stdout with two frames:
+    1. json reply: {'stderr': ...}, where `stderr` holds the messages the
+       filter would have written to stderr as an external filter
+    2. filtered document as json
+
+`serve` and `serve_actions` implement the worker's side of the protocol
+for filters written in Python.
+"""
+import atexit
+import io
+import json
+import os
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import pandocfilters
+from . import cache
+from . import const
+from . import info
+from . import util
+
+# - environment variable set for filters started as workers
+ENV_VAR = 'PANZER_FILTER_WORKER'
+
+# - lists of idle workers, keyed by command and environment
+WORKERS = dict()
+
+# - keys of commands that failed to start as workers or timed out (with
+# - fingerprint of their file, so that they are tried again once changed)
+UNUSABLE = set()
+
+# - held while `WORKERS` or `UNUSABLE` is read or changed
+LOCK = threading.Lock()
+
+class WorkerError(Exception):
+    """ worker died or broke the protocol """
+    pass
+
+class WorkerTimeout(WorkerError):
+    """ worker did not reply in time """
+    pass
+
+class FilterWorker(object):
+    """ a filter process that handles a stream of jobs """
+    def __init__(self, command, env):
+        """ start worker running `command` with environment `env` """
+        env = dict(env)
+        env[ENV_VAR] = '1'
+        self.command = command
+        self.jobs = 0
+        self.process = subprocess.Popen([command],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        env=env)
+        # - wait for worker to say it speaks the protocol
+        try:
+            hello_bytes = self.read_frame(time.monotonic()
+                                          + const.FILTER_WORKER_START_TIMEOUT)
+            if hello_bytes is None:
+                raise WorkerError('worker exited')
+            hello = json.loads(hello_bytes.decode(const.ENCODING))
+            if hello.get('protocol') != const.FILTER_WORKER_PROTOCOL:
+                raise WorkerError('unsupported protocol: %s' % hello.get('protocol'))
+        except (OSError, EOFError, ValueError, AttributeError, WorkerError) as err:
+            self.kill()
+            raise WorkerError(err)
+
+    def run(self, arguments, in_bytes):
+        """
+        return filtered document and stderr messages of job filtering json
+        `in_bytes` with command line `arguments`
+        raises WorkerError if worker dies or breaks protocol, and
+        WorkerTimeout if it does not reply within
+        `const.FILTER_WORKER_JOB_TIMEOUT` seconds
+        """
+        request = json.dumps({'arguments': arguments}).encode(const.ENCODING)
+        deadline = time.monotonic() + const.FILTER_WORKER_JOB_TIMEOUT
+        # - send job from another thread: a worker that stops reading its
+        # - stdin must not block panzer before the deadline is checked
+        errors = list()
+        def send():
+            """ write job to worker's stdin """
+            try:
+                util.write_frame(self.process.stdin, request)
+                util.write_frame(self.process.stdin, in_bytes)
+            except OSError as err:
+                errors.append(err)
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        try:
+            reply_bytes = self.read_frame(deadline)
+            out_bytes = self.read_frame(deadline)
+            sender.join(max(0, deadline - time.monotonic()))
+            if sender.is_alive():
+                raise WorkerTimeout('replied without reading whole job')
+        except (OSError, EOFError) as err:
+            raise WorkerError(err)
+        if errors:
+            raise WorkerError(errors[0])
+        if reply_bytes is None or out_bytes is None:
+            raise WorkerError('worker exited')
+        try:
+            reply = json.loads(reply_bytes.decode(const.ENCODING))
+        except ValueError as err:
+            raise WorkerError('bad reply: %s' % err)
+        self.jobs += 1
+        return out_bytes, reply.get('stderr', '')
+
+    def read_frame(self, deadline):
+        """
+        return bytes of next length-prefixed frame (see `util.read_frame`)
+        from worker's stdout, or None if it closed before a frame started
+        raises WorkerTimeout if frame is not read by time `deadline` (from
+        `time.monotonic`)
+        """
+        header = self.read_bytes(8, deadline)
+        if not header:
+            return None
+        if len(header) != 8:
+            raise EOFError('stream closed inside frame header')
+        size = struct.unpack('>Q', header)[0]
+        data = self.read_bytes(size, deadline)
+        if len(data) != size:
+            raise EOFError('stream closed inside frame')
+        return data
+
+    def read_bytes(self, size, deadline):
+        """
+        return `size` bytes read from worker's stdout (fewer if it closes)
+        raises WorkerTimeout if they are not read by time `deadline`
+        """
+        # - read the pipe itself: select cannot see a file object's buffer
+        fd = self.process.stdout.fileno()
+        chunks = list()
+        remaining = size
+        while remaining:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not select.select([fd], [], [], timeout)[0]:
+                raise WorkerTimeout('timed out waiting for reply')
+            chunk = os.read(fd, min(remaining, const.PIPE_CHUNK_SIZE))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def kill(self):
+        """ kill worker and wait for it """
+        self.process.kill()
+        self.process.wait()
+
+    def stop(self):
+        """ ask worker to exit (by closing its stdin) and wait for it """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=const.FILTER_WORKER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+def run(entry, in_bytes, options):
+    """
+    return filtered document and stderr messages of running persistent
+    filter `entry` on json `in_bytes`, with a worker checked out of the
+    pool (and restarted as needed)
+    raises WorkerError or OSError if the job cannot be run
+    """
+    env = util.child_env(options)
+    key = (entry['command'], env['PANZER_SHARED'])
+    unusable_key = (key, repr(cache.file_fingerprint(entry['command'])))
+    for attempt in range(2):
+        worker = check_out(key, unusable_key, entry['command'], env)
+        try:
+            result = worker.run(entry['arguments'], in_bytes)
+        except WorkerTimeout:
+            # - a hung worker is not restarted until its file changes
+            worker.kill()
+            with LOCK:
+                UNUSABLE.add(unusable_key)
+            raise
+        except WorkerError as err:
+            worker.stop()
+            if attempt > 0:
+                raise
+            info.log('WARNING', 'panzer', 'worker "%s" failed (%s)---restarting it'
+                     % (entry['command'], err))
+            continue
+        if worker.jobs >= const.FILTER_WORKER_MAX_JOBS:
+            info.log('DEBUG', 'panzer', 'retiring worker "%s" after %d jobs'
+                     % (entry['command'], worker.jobs))
+            worker.stop()
+        else:
+            check_in(key, worker)
+        return result
+
+def check_out(key, unusable_key, command, env):
+    """
+    return idle worker from pool `key`, or start a new worker running
+    `command` if none is idle
+    raises WorkerError or OSError if the worker cannot be started
+    """
+    with LOCK:
+        if unusable_key in UNUSABLE:
+            raise WorkerError('failed to start, or timed out, before')
+        idle = WORKERS.get(key)
+        if idle:
+            return idle.pop()
+    info.log('DEBUG', 'panzer', 'starting worker "%s"' % command)
+    # - a worker that cannot start is not retried
+    try:
+        return FilterWorker(command, env)
+    except (OSError, WorkerError):
+        with LOCK:
+            UNUSABLE.add(unusable_key)
+        raise
+
+def check_in(key, worker):
+    """ return `worker` to pool `key` once its job is done """
+    with LOCK:
+        WORKERS.setdefault(key, list()).append(worker)
+
+@atexit.register
+def stop_all():
+    """ stop all idle workers """
+    with LOCK:
+        workers = [worker for idle in WORKERS.values() for worker in idle]
+        WORKERS.clear()
+    for worker in workers:
+        worker.stop()
+
+# Worker side of the protocol
+
+def requested():
+    """ return True if this filter has been started as a persistent worker """
+    return os.environ.get(ENV_VAR) == '1'
+
+def serve(function):
+    """
+    handle jobs sent by panzer until it closes stdin
+    `function(ast, arguments)`: returns filtered document `ast` (decoded
+    json), given the filter's command line `arguments`; what it writes to
+    stdout or stderr is sent back as the filter's messages
+    """
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    hello = json.dumps({'protocol': const.FILTER_WORKER_PROTOCOL})
+    util.write_frame(stdout, hello.encode(const.ENCODING))
+    stdout.flush()
+    while True:
+        request_bytes = util.read_frame(stdin)
+        in_bytes = util.read_frame(stdin)
+        if request_bytes is None or in_bytes is None:
+            return
+        request = json.loads(request_bytes.decode(const.ENCODING))
+        messages = io.StringIO()
+        saved = (sys.stdout, sys.stderr, sys.argv)
+        sys.stdout = sys.stderr = messages
+        sys.argv = [sys.argv[0]] + request['arguments']
+        try:
+            ast = function(json.loads(in_bytes.decode(const.ENCODING)),
+                           request['arguments'])
+            out_bytes = json.dumps(ast).encode(const.ENCODING)
+        except Exception:       # pylint: disable=W0703
+            # - report error and pass document on unchanged
+            for line in traceback.format_exc().splitlines():
+                messages.write(json.dumps({'level': 'ERROR',
+                                           'message': line}) + '\n')
+            out_bytes = in_bytes
+        finally:
+            sys.stdout, sys.stderr, sys.argv = saved
+        reply = json.dumps({'stderr': messages.getvalue()})
+        util.write_frame(stdout, reply.encode(const.ENCODING))
+        util.write_frame(stdout, out_bytes)
+        stdout.flush()
+
+def serve_actions(actions):
+    """ handle jobs sent by panzer by applying pandocfilters `actions` """
+    def function(ast, arguments):
+        """ apply actions as pandocfilters' `toJSONFilters` would """
+        writer = arguments[0] if arguments else ''
+        if 'meta' in ast:
+            metadata = ast['meta']
+        elif isinstance(ast, list) and ast[0]:
+            metadata = ast[0]['unMeta']
+        else:
+            metadata = dict()
+        for action in actions:
+            ast = pandocfilters.walk(ast, action, writer, metadata)
+        return ast
+    serve(function)